@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+'''
+Runs `restore:<env>` end to end against a simulated fleet and reports where the time went.
+
+Nothing leaves this machine: the fleet's hostnames resolve to a local listener (so discovery
+probes succeed), remote commands go through a fake transport instead of ssh, and array
+operations go through benchmarks/naviseccli_sim.py.
+
+The fake transport charges every run()/sudo() one round trip (--rtt) plus a configurable delay
+for each of the commands it contains (service, mount, umount, lsof, pkill, kill, mysqld, rm, ...)
+and any `sleep`. Shell loops are charged for a single pass. Opening a connection (the ssh
+handshake and auth) is charged the `connect` delay, once per host in every process, like
+fabric's connection cache. Every call is logged, so the report can count round trips per role.
+
+Examples:
+
+  Restore dev with 5, 20 and 50 nodes per role:
+    $ python benchmarks/fleet_sim.py --nodes 5 20 50
+
+  Slow service restarts, and a slow array:
+    $ NAVISIM_LATENCY=0.5 NAVISIM_SETTLE=3 python benchmarks/fleet_sim.py --delay service=4,umount=0.5
+'''
+
+import argparse, json, os, re, shutil, socket, subprocess, sys, tempfile, threading, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fabric.operations
+from fabric.api import env, execute
+from fabric.main import load_fabfile
+from fabric.network import HostConnectionCache, normalize_to_string
+from fabric.state import commands, connections, output
+
+SIMULATOR = os.path.join(ROOT, 'benchmarks', 'naviseccli_sim.py')
+ROLES     = ['mongo', 'mysql', 'web', 'php']
+
+DEFAULT_DELAYS = 'connect=0.3,service=1.0,mount=0.1,umount=0.2,lsof=0.05,pkill=0.05,kill=0.01,mysqld=2.0,rm=0.01,default=0.01'
+
+COMMAND = re.compile(r'\b(service|mount|umount|lsof|pkill|kill|mysqld|rm|grep)\b')
+SLEEP   = re.compile(r'\bsleep\s+(\d+(?:\.\d+)?)')
+
+
+def parse_delays(value):
+  delays = {}
+  for part in [p.strip() for p in value.split(',') if p.strip()]:
+    name, seconds = part.split('=', 1)
+    delays[name.strip()] = float(seconds)
+  return delays
+
+
+class FakeFleet(object):
+  '''
+  Stands in for fabric's remote execution: _execute() is called by run()/sudo() in place of
+  running the command over ssh, sleeps for what the command would have cost and logs the call.
+  '''
+  def __init__(self, log_path, delays, rtt):
+    self.log_path = log_path
+    self.delays   = delays
+    self.rtt      = rtt
+
+  def cost(self, command):
+    seconds = self.rtt
+    for name in COMMAND.findall(command):
+      seconds += self.delays.get(name, self.delays['default'])
+    for sleep in SLEEP.findall(command):
+      seconds += float(sleep)
+    return seconds
+
+  def _execute(self, channel, command, **kwargs):
+    # opens the connection, unless this process already has it
+    connections[env.host_string]
+
+    seconds = self.cost(command)
+    time.sleep(seconds)
+    self.log(env.host_string, seconds, command)
+    return '', '', 0
+
+  def connect(self, cache, key):
+    time.sleep(self.delays['connect'])
+    dict.__setitem__(cache, normalize_to_string(key), FakeConnection())
+    self.log(key, self.delays['connect'], 'connect')
+
+  def log(self, host_string, seconds, command):
+    host = re.sub('^[^@]+@', '', host_string or '')
+    line = json.dumps({ 'host': host, 'role': re.sub('\d.*$', '', host), 'seconds': seconds, 'command': command })
+    # O_APPEND keeps lines from parallel (forked) tasks whole
+    fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+      os.write(fd, line + "\n")
+    finally:
+      os.close(fd)
+
+  def install(self):
+    fabric.operations.default_channel = lambda: None
+    fabric.operations._execute = self._execute
+    HostConnectionCache.connect = lambda cache, key: self.connect(cache, key)
+
+
+class FakeConnection(object):
+  def close(self):
+    pass
+
+
+class FakeResolver(object):
+  '''Resolves the fleet's hostnames to a local listener, and every other lipsum.com name to nothing'''
+  def __init__(self, environment, nodes):
+    self.pattern  = re.compile(r'^(%s)(\d+)\.%s\.lipsum\.com$' % ('|'.join(ROLES), re.escape(environment)))
+    self.nodes    = nodes
+    self.listener = socket.socket()
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(1024)
+    self.original = socket.getaddrinfo
+
+    def accept():
+      while True:
+        connection, address = self.listener.accept()
+        connection.close()
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+
+  def getaddrinfo(self, host, port, *args):
+    match = self.pattern.match(host)
+    if match and 1 <= int(match.group(2)) <= self.nodes:
+      return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', self.listener.getsockname())]
+    if host.endswith('lipsum.com'):
+      raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+    return self.original(host, port, *args)
+
+  def install(self):
+    socket.getaddrinfo = self.getaddrinfo
+
+
+def summarize(spans, calls, wall):
+  phases = {}
+  for span in spans:
+    phase = phases.setdefault(span['label'], { 'count': 0, 'total': 0.0, 'max': 0.0, 'failed': 0 })
+    phase['count'] += 1
+    phase['total'] += span['duration']
+    phase['max']    = max(phase['max'], span['duration'])
+    phase['failed'] += span['state'] != 'succeeded'
+
+  round_trips = {}
+  for call in calls:
+    round_trips[call['role']] = round_trips.get(call['role'], 0) + 1
+
+  return {
+    'wall_clock':       wall,
+    'phases':           phases,
+    'round_trips':      sum(round_trips.values()),
+    'round_trips_role': round_trips,
+    'remote_seconds':   sum(call['seconds'] for call in calls)
+  }
+
+
+def run_restore(environment, nodes, delays, rtt, workdir):
+  '''Restores environment against a fleet of `nodes` hosts per role, in a child process'''
+  os.environ['NAVISIM_STATE'] = os.path.join(workdir, 'array.json')
+  hosts = ["%s%02d" % (role, i) for role in ('mongo', 'mysql') for i in range(1, nodes + 1)]
+  subprocess.check_call([sys.executable, SIMULATOR, 'init', '-e', environment, '--hosts'] + hosts)
+
+  log_path   = os.path.join(workdir, 'calls.jsonl')
+  trace_path = os.path.join(workdir, 'trace.jsonl')
+
+  FakeResolver(environment, nodes).install()
+  FakeFleet(log_path, delays, rtt).install()
+
+  docstring, callables, default = load_fabfile(os.path.join(ROOT, 'fabfile'))
+  commands.update(callables)
+
+  from fabfile import util
+  env.max_node_index       = nodes + 1
+  env.discovery_cache      = None
+  env.benchmark_history    = None
+  env.trace_file           = trace_path
+  env.navisphere['cli']    = "%s %s" % (sys.executable, SIMULATOR)
+  env.abort_on_prompts     = True
+
+  start = time.time()
+  try:
+    execute('restore', environment)
+    failed = False
+  except SystemExit:
+    failed = True
+  wall = time.time() - start
+
+  spans  = util.load_spans(trace_path) if os.path.exists(trace_path) else []
+  calls  = util.load_spans(log_path) if os.path.exists(log_path) else []
+  result = summarize(spans, calls, wall)
+  result.update(nodes=nodes, failed=failed)
+  return result
+
+
+parser = argparse.ArgumentParser(description='Benchmark restore against a simulated fleet')
+parser.add_argument('-e', '--environment', default='dev', help='Environment to restore (default = dev)')
+parser.add_argument('-n', '--nodes', nargs='*', type=int, default=[5, 20, 50], help='Nodes per role to simulate')
+parser.add_argument('--delay', default='', help='Per-command delays, e.g. "service=2,umount=0.5" (defaults: %s)' % DEFAULT_DELAYS)
+parser.add_argument('--rtt', type=float, default=0.005, help='Seconds per simulated ssh round trip (default = 0.005)')
+parser.add_argument('-v', '--verbose', action='store_true', help='Show fabric output')
+parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+
+
+if __name__ == '__main__':
+  args   = parser.parse_args()
+  delays = parse_delays(DEFAULT_DELAYS)
+  delays.update(parse_delays(args.delay))
+
+  if not args.verbose:
+    for level in output.keys():
+      output[level] = False
+
+  report = { 'environment': args.environment, 'delays': delays, 'rtt': args.rtt, 'runs': [] }
+  for nodes in args.nodes:
+    workdir = tempfile.mkdtemp(prefix='fleet_sim.')
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      # each fleet size gets a fresh process, so no state carries over between runs
+      os.close(read)
+      try:
+        os.write(write, json.dumps(run_restore(args.environment, nodes, delays, args.rtt, workdir)))
+      finally:
+        os._exit(0)
+    os.close(write)
+    result = ''
+    while True:
+      chunk = os.read(read, 65536)
+      if not chunk:
+        break
+      result += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    shutil.rmtree(workdir, True)
+    report['runs'].append(json.loads(result) if result else { 'nodes': nodes, 'failed': True })
+
+  report = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(report + "\n")
+  else:
+    print report
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+'''
+A stand-in for naviseccli that models LUNs, snapshots and snapshot mount point (SMP) attachments,
+so array operations can be exercised and benchmarked without the production array.
+
+It understands the commands fabfile.sanclient and envrestore.py issue:
+
+  lun -list [-id N | -name NAME]
+  snap -list [-id NAME] [-detail]
+  snap -create -res LUN -restype lun -name NAME [-allowReadWrite yes]
+  snap -destroy -id NAME [-o]
+  snap -attach -id NAME -res SMP
+  snap -detach -id NAME -res SMP
+
+Global options (-Address/-h, -secfilepath, -User, -Password, -Scope) are accepted and ignored.
+Each invocation is a separate process, so the model is kept in a JSON state file
+(NAVISIM_STATE, default /tmp/naviseccli_sim.json) and updated under a lock.
+
+Like the real array, some changes take a while to settle: a destroyed snapshot stays listed (and
+its name taken) as 'Destroying', and a new snapshot or attachment only shows up as 'Ready' or in
+'Attached LUN(s)' once NAVISIM_SETTLE seconds have passed. NAVISIM_LATENCY adds a delay to every
+command. Both take either seconds, or per-command seconds such as "list=0.2,create=1.5,default=0.5".
+
+Examples:
+
+  Seed a model with the dev and qa mongo/mysql SMPs and snapshots, plus 5000 other LUNs:
+    $ benchmarks/naviseccli_sim.py init -e dev qa --extra-luns 5000
+
+  Restore against it, with half a second per command and five seconds to settle:
+    $ NAVISIM_LATENCY=0.5 NAVISIM_SETTLE=5 fab naviseccli:benchmarks/naviseccli_sim.py restore:dev
+'''
+
+import argparse, fcntl, json, os, sys, time
+from contextlib import contextmanager
+
+STATE_PATH = os.environ.get('NAVISIM_STATE', '/tmp/naviseccli_sim.json')
+
+GLOBAL_OPTIONS = ['-Address', '-h', '-secfilepath', '-User', '-Password', '-Scope']
+
+# primary LUNs snapshots are taken from (see envrestore.py)
+PRIMARY_LUNS = { 'mongo': 3, 'mysql': 4 }
+
+FIRST_SMP_LUN = 4000
+
+
+class ArrayError(Exception):
+  def __init__(self, message, code=1):
+    Exception.__init__(self, message)
+    self.code = code
+
+
+def timings(name, default=0.0):
+  '''Parses NAVISIM_LATENCY/NAVISIM_SETTLE into { command: seconds } with a 'default' entry'''
+  value   = os.environ.get(name, '')
+  timings = { 'default': default }
+  for part in [p.strip() for p in value.split(',') if p.strip()]:
+    if '=' in part:
+      command, seconds = part.split('=', 1)
+      timings[command.strip()] = float(seconds)
+    else:
+      timings['default'] = float(part)
+  return timings
+
+
+def timing(timings, command):
+  return timings.get(command, timings['default'])
+
+
+class ArraySimulator(object):
+  '''
+  The array model: luns maps id -> { name, smp }, snapshots maps name -> { lun, created, ready_at,
+  destroy_at, attached: { smp id: visible at } }
+  '''
+  def __init__(self, state=None, settle=None):
+    state          = state or {}
+    self.luns      = dict((int(i), lun) for i, lun in state.get('luns', {}).items())
+    self.snapshots = state.get('snapshots', {})
+    self.settle    = settle if settle is not None else timings('NAVISIM_SETTLE')
+
+  def state(self):
+    return { 'luns': self.luns, 'snapshots': self.snapshots }
+
+  def now(self):
+    return time.time()
+
+  def expire(self):
+    '''Forgets snapshots whose destroy has finished settling'''
+    for name, snapshot in list(self.snapshots.items()):
+      if snapshot.get('destroy_at') and snapshot['destroy_at'] <= self.now():
+        del self.snapshots[name]
+
+  def add_lun(self, name, lun_id=None, smp=False):
+    lun_id = lun_id if lun_id is not None else max(self.luns.keys() + [FIRST_SMP_LUN * 2]) + 1
+    self.luns[lun_id] = { 'name': name, 'smp': smp }
+    return lun_id
+
+  def find_lun(self, lun_id=None, name=None):
+    for i, lun in self.luns.items():
+      if i == lun_id or (name is not None and lun['name'] == name):
+        return i, lun
+    raise ArrayError("Could not retrieve the specified (pool lun). The (pool lun) may not exist", 11)
+
+  def find_snapshot(self, name):
+    if name not in self.snapshots:
+      raise ArrayError("Could not retrieve the specified (Snapshot). The (Snapshot) may not exist", 3)
+    return self.snapshots[name]
+
+  def create_snapshot(self, name, lun_id):
+    if name in self.snapshots:
+      raise ArrayError("The specified snapshot name is already in use.", 5)
+    self.find_lun(lun_id)
+    self.snapshots[name] = {
+      'lun':      lun_id,
+      'created':  self.now(),
+      'ready_at': self.now() + timing(self.settle, 'create'),
+      'attached': {}
+    }
+
+  def destroy_snapshot(self, name):
+    snapshot = self.find_snapshot(name)
+    if snapshot.get('destroy_at'):
+      raise ArrayError("The snapshot is already being destroyed.", 6)
+    if snapshot['attached']:
+      raise ArrayError("The snapshot is attached to a snapshot mount point and cannot be destroyed.", 7)
+    snapshot['destroy_at'] = self.now() + timing(self.settle, 'destroy')
+
+  def attach_snapshot(self, name, smp_id):
+    snapshot = self.find_snapshot(name)
+    i, smp   = self.find_lun(smp_id)
+    if snapshot.get('destroy_at'):
+      raise ArrayError("The snapshot is being destroyed.", 6)
+    if not smp['smp']:
+      raise ArrayError("The specified LUN is not a snapshot mount point.", 8)
+    for other in self.snapshots.values():
+      if str(i) in other['attached']:
+        raise ArrayError("The snapshot mount point already has a snapshot attached.", 9)
+    snapshot['attached'][str(i)] = self.now() + timing(self.settle, 'attach')
+
+  def detach_snapshot(self, name, smp_id):
+    snapshot = self.find_snapshot(name)
+    i, smp   = self.find_lun(smp_id)
+    if str(i) not in snapshot['attached']:
+      raise ArrayError("The snapshot is not attached to the specified snapshot mount point.", 10)
+    del snapshot['attached'][str(i)]
+
+  def attached_to(self, smp_id):
+    for name, snapshot in self.snapshots.items():
+      if snapshot['attached'].get(str(smp_id), float('inf')) <= self.now():
+        return name
+    return None
+
+  def lun_record(self, lun_id):
+    lun   = self.luns[lun_id]
+    lines = [
+      "LOGICAL UNIT NUMBER %d" % lun_id,
+      "Name:  %s" % lun['name'],
+      "UID:  60:06:01:60:00:00:00:00:00:00:00:00:%08X" % lun_id,
+      "Current Owner:  SP A",
+      "User Capacity (GBs):  1024.000",
+      "Current State:  Ready",
+      "Is Pool LUN:  Yes",
+      "Is Snapshot Mount Point:  %s" % ('Yes' if lun['smp'] else 'No'),
+    ]
+    if lun['smp']:
+      lines.append("Attached Snapshot:  %s" % (self.attached_to(lun_id) or 'N/A'))
+    return "\n".join(lines)
+
+  def snapshot_record(self, name, detail):
+    snapshot = self.snapshots[name]
+    if snapshot.get('destroy_at'):
+      state = 'Destroying'
+    elif snapshot['ready_at'] > self.now():
+      state = 'Initializing'
+    else:
+      state = 'Ready'
+    attached = sorted(int(i) for i, at in snapshot['attached'].items() if at <= self.now())
+
+    lines = [
+      "Name:  %s" % name,
+      "Description:  ",
+      "Creation time:  %s" % time.strftime("%a %b %d %H:%M:%S %Y", time.localtime(snapshot['created'])),
+      "Primary LUN(s):  %d" % snapshot['lun'],
+      "State:  %s" % state,
+    ]
+    if detail:
+      lines += [
+        "Allow Read/Write:  Yes",
+        "Modified:  No",
+        "Allow auto delete:  No",
+        "Expiration date:  None",
+        "Attached LUN(s):  %s" % (', '.join(str(i) for i in attached) or 'N/A'),
+      ]
+    return "\n".join(lines)
+
+  def run(self, args, stdin=sys.stdin):
+    '''Runs one naviseccli command (without global options), returning its output'''
+    self.expire()
+    options = parse_options(args[2:])
+    command = ' '.join(args[:2])
+
+    if command == 'lun -list':
+      if '-id' in options:
+        ids = [self.find_lun(lun_id=int(options['-id']))[0]]
+      elif '-name' in options:
+        ids = [self.find_lun(name=options['-name'])[0]]
+      else:
+        ids = sorted(self.luns)
+      return "\n\n".join(self.lun_record(i) for i in ids)
+
+    elif command == 'snap -list':
+      names = [options['-id']] if '-id' in options else sorted(self.snapshots)
+      for name in names:
+        self.find_snapshot(name)
+      return "\n\n".join(self.snapshot_record(name, '-detail' in options) for name in names)
+
+    elif command == 'snap -create':
+      self.create_snapshot(options['-name'], int(options['-res']))
+
+    elif command == 'snap -destroy':
+      if '-o' not in options:
+        sys.stdout.write("Are you sure you want to perform this operation?(y/n): ")
+        sys.stdout.flush()
+        if not stdin.readline().strip().lower().startswith('y'):
+          return ''
+      self.destroy_snapshot(options['-id'])
+
+    elif command == 'snap -attach':
+      self.attach_snapshot(options['-id'], int(options['-res']))
+
+    elif command == 'snap -detach':
+      self.detach_snapshot(options['-id'], int(options['-res']))
+
+    else:
+      raise ArrayError("Unsupported command: %s" % ' '.join(args), 2)
+    return ''
+
+
+def parse_options(args):
+  options = {}
+  while args:
+    option = args.pop(0)
+    if args and not args[0].startswith('-'):
+      options[option] = args.pop(0)
+    else:
+      options[option] = True
+  return options
+
+
+def strip_global_options(args):
+  args = list(args)
+  for option in GLOBAL_OPTIONS:
+    while option in args:
+      i = args.index(option)
+      del args[i:i + 2]
+  return args
+
+
+@contextmanager
+def simulator(path=STATE_PATH):
+  '''Loads the model from path, hands it out and writes it back, holding a lock throughout'''
+  with open(path + '.lock', 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      state = json.load(open(path)) if os.path.exists(path) else {}
+      model = ArraySimulator(state)
+      yield model
+      with open(path + '.tmp', 'w') as f:
+        json.dump(model.state(), f)
+      os.rename(path + '.tmp', path)
+    finally:
+      fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def init(argv):
+  parser = argparse.ArgumentParser(prog='naviseccli_sim.py init', description='Seed a new array model')
+  parser.add_argument('-e', '--environments', nargs='+', default=['dev'], help='Environments to create SMPs and snapshots for')
+  parser.add_argument('--hosts', nargs='+', default=['mongo01', 'mysql01'], help='Database hosts in each environment')
+  parser.add_argument('--extra-luns', type=int, default=0, help='Number of unrelated LUNs to add')
+  args = parser.parse_args(argv)
+
+  model = ArraySimulator(settle={ 'default': 0.0 })
+  for kind, lun_id in PRIMARY_LUNS.items():
+    model.add_lun("%s primary" % kind, lun_id)
+  for i in range(args.extra_luns):
+    model.add_lun("LUN %d" % i, 10 + len(PRIMARY_LUNS) + i)
+
+  smp_id = FIRST_SMP_LUN
+  for environment in args.environments:
+    for host in args.hosts:
+      kind = 'mysql' if 'mysql' in host else 'mongo'
+      smp_id += 1
+      model.add_lun("%s-%s-smp" % (host, environment), smp_id, smp=True)
+      model.create_snapshot("%s-%s-snap" % (host, environment), PRIMARY_LUNS[kind])
+      model.attach_snapshot("%s-%s-snap" % (host, environment), smp_id)
+
+  with simulator() as current:
+    current.luns, current.snapshots = model.luns, model.snapshots
+
+
+def main(argv):
+  if argv[:1] == ['init']:
+    return init(argv[1:])
+
+  args    = strip_global_options(argv)
+  latency = timing(timings('NAVISIM_LATENCY'), args[1].lstrip('-') if len(args) > 1 else 'default')
+  time.sleep(latency)
+
+  try:
+    with simulator() as model:
+      output = model.run(args)
+  except ArrayError, e:
+    sys.stderr.write("%s\n" % e)
+    return e.code
+
+  if output:
+    sys.stdout.write(output + "\n")
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+'''
+Benchmarks fabfile.sanclient parsing and lookups against synthetic naviseccli output.
+
+Generates `lun -list` and `snap -list -detail` style output for 100, 1k, 10k and 50k objects,
+times _parse_object_list, _parse_lun_record/_parse_snapshot_record, add_property and the
+get_*_by_* lookups, and reports throughput (objects or calls per second) and peak memory as JSON.
+Like timeit.repeat, every benchmark runs several times and the best time is kept, so a single
+noisy run doesn't read as a regression.
+
+Examples:
+
+  Run the suite and store the results as the baseline:
+    $ python benchmarks/sanclient_bench.py --save-baseline benchmarks/baseline.json
+
+  Run it again after changing the parser and compare against that baseline:
+    $ python benchmarks/sanclient_bench.py --baseline benchmarks/baseline.json
+'''
+
+import argparse, json, os, resource, sys, time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabfile.sanclient import Lun, VnxClient, VnxConfig
+
+SIZES   = [100, 1000, 10000, 50000]
+LOOKUPS = 1000
+
+# times each benchmark is run; the fastest run is the one reported and compared
+REPEAT  = 5
+
+# throughput drops beyond this fraction of the baseline are reported as regressions
+REGRESSION_THRESHOLD = 0.10
+
+
+def lun_listing(count):
+  records = []
+  for i in range(count):
+    records.append("\n".join([
+      "LOGICAL UNIT NUMBER %d" % i,
+      "Name:  LUN %d" % i,
+      "UID:  60:06:01:60:%08X:%08X" % (i, i * 7),
+      "Current Owner:  SP %s" % ('A' if i % 2 else 'B'),
+      "Default Owner:  SP A",
+      "Allocation Owner:  SP A",
+      "User Capacity (Blocks):  %d" % (2097152 * (i % 64 + 1)),
+      "User Capacity (GBs):  %d.000" % (i % 64 + 1),
+      "Consumed Capacity (GBs):  %.3f" % ((i % 64 + 1) * 0.75),
+      "Pool Name:  Pool %d" % (i % 4),
+      "Raid Type:  r_5",
+      "Offset:  0",
+      "Auto-Assign Enabled:  DISABLED",
+      "Auto-Trespass Enabled:  DISABLED",
+      "Current State:  Ready",
+      "Status:  OK(0x0)",
+      "Is Faulted:  false",
+      "Is Transitioning:  false",
+      "Current Operation:  None",
+      "Current Operation State:  N/A",
+      "Is Pool LUN:  Yes",
+      "Is Thin LUN:  %s" % ('Yes' if i % 3 else 'No'),
+      "Is Private:  No",
+      "Is Compressed:  No",
+      "Tiering Policy:  Auto Tier",
+      "Initial Tier:  Optimize Pool",
+      "Is Snapshot Mount Point:  %s" % ('Yes' if i % 10 == 0 else 'No'),
+    ]))
+  return "\n\n".join(records) + "\n"
+
+
+def snapshot_listing(count):
+  records = []
+  for i in range(count):
+    records.append("\n".join([
+      "Name:  host%02d-env%d-snap" % (i % 100, i),
+      "Description:  ",
+      "Creation time:  Mon Oct 12 10:%02d:%02d 2026" % (i / 60 % 60, i % 60),
+      "Primary LUN(s):  %d" % (i % 16),
+      "Source CG:  N/A",
+      "State:  Ready",
+      "Allow Read/Write:  Yes",
+      "Modified:  %s" % ('Yes' if i % 2 else 'No'),
+      "Allow auto delete:  No",
+      "Expiration date:  None",
+      "Attached LUN(s):  %s" % (4000 + i if i % 4 == 0 else 'N/A'),
+    ]))
+  return "\n\n".join(records) + "\n"
+
+
+def timed(func, *args, **kwargs):
+  '''Runs func `repeat` times, returning its (last) result and the best of the times it took'''
+  best = None
+  for i in range(kwargs.get('repeat', 1)):
+    start   = time.time()
+    result  = func(*args)
+    seconds = time.time() - start
+    best    = seconds if best is None else min(best, seconds)
+  return result, best
+
+
+def rate(count, seconds):
+  return count / seconds if seconds > 0 else float('inf')
+
+
+def bench_size(count, repeat=REPEAT):
+  '''
+  Runs every benchmark for one array size, best of `repeat` runs each, returning
+  { name: { seconds, throughput } }
+  '''
+  client   = VnxClient(VnxConfig())
+  results  = {}
+  luns     = lun_listing(count)
+  snaps    = snapshot_listing(count)
+
+  def record(name, operations, seconds):
+    results[name] = { 'operations': operations, 'seconds': seconds, 'throughput': rate(operations, seconds) }
+
+  lun_records, seconds = timed(lambda: list(client._parse_object_list(luns)), repeat=repeat)
+  record('parse_object_list.lun', count, seconds)
+
+  snap_records, seconds = timed(lambda: list(client._parse_object_list(snaps)), repeat=repeat)
+  record('parse_object_list.snapshot', count, seconds)
+
+  parsed_luns, seconds = timed(lambda: [client._parse_lun_record(r) for r in lun_records], repeat=repeat)
+  record('parse_lun_record', count, seconds)
+
+  parsed_snaps, seconds = timed(lambda: [client._parse_snapshot_record(r) for r in snap_records], repeat=repeat)
+  record('parse_snapshot_record', count, seconds)
+
+  properties = [client._split_property(line.strip()) for line in lun_records[0][1:]]
+  def add_properties():
+    for i in xrange(count):
+      lun = Lun()
+      for name, value in properties:
+        lun.add_property(name, value)
+  _, seconds = timed(add_properties, repeat=repeat)
+  record('add_property', count * len(properties), seconds)
+
+  client._luns = parsed_luns
+  client._snapshots = parsed_snaps
+  _, seconds = timed(client._rebuild_indexes, 'lun', repeat=repeat)
+  record('index.lun', count, seconds)
+  _, seconds = timed(client._rebuild_indexes, 'snapshot', repeat=repeat)
+  record('index.snapshot', count, seconds)
+
+  # spread the lookups over the whole listing, including the far end of it
+  targets = [(i * 7919) % count for i in range(LOOKUPS)]
+  _, seconds = timed(lambda: [client.get_lun_by_id(i) for i in targets], repeat=repeat)
+  record('get_lun_by_id', LOOKUPS, seconds)
+  _, seconds = timed(lambda: [client.get_lun_by_name('LUN %d' % i) for i in targets], repeat=repeat)
+  record('get_lun_by_name', LOOKUPS, seconds)
+  _, seconds = timed(lambda: [client.get_snapshot_by_name('host%02d-env%d-snap' % (i % 100, i)) for i in targets], repeat=repeat)
+  record('get_snapshot_by_name', LOOKUPS, seconds)
+
+  return results
+
+
+def run_isolated(count, repeat=REPEAT):
+  '''Runs bench_size in a child process so each size gets its own peak memory figure'''
+  queue = Queue()
+
+  def child():
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results = bench_size(count, repeat)
+    queue.put({
+      'objects':        count,
+      'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss,
+      'benchmarks':     results
+    })
+
+  process = Process(target=child)
+  process.start()
+  result = queue.get()
+  process.join()
+  return result
+
+
+def compare(results, baseline):
+  '''Lists the benchmarks whose throughput changed against the baseline, flagging regressions'''
+  changes = []
+  for size, current in results['sizes'].items():
+    previous = baseline.get('sizes', {}).get(size)
+    if not previous:
+      continue
+    for name, bench in current['benchmarks'].items():
+      if name not in previous['benchmarks']:
+        continue
+      ratio = bench['throughput'] / previous['benchmarks'][name]['throughput']
+      changes.append({
+        'objects':    int(size),
+        'benchmark':  name,
+        'speedup':    ratio,
+        'regression': ratio < 1 - REGRESSION_THRESHOLD
+      })
+    changes.append({
+      'objects':      int(size),
+      'benchmark':    'peak_memory_kb',
+      'memory_ratio': float(current['peak_memory_kb']) / max(previous['peak_memory_kb'], 1)
+    })
+  return sorted(changes, key=lambda change: (change['objects'], change['benchmark']))
+
+
+parser = argparse.ArgumentParser(description='Benchmark fabfile.sanclient parsing and lookups')
+parser.add_argument('-s', '--sizes', nargs='*', type=int, default=SIZES, help='Number of objects to generate (default = %s)' % SIZES)
+parser.add_argument('-r', '--repeat', type=int, default=REPEAT, help='Runs of each benchmark, of which the best is kept (default = %d)' % REPEAT)
+parser.add_argument('-b', '--baseline', help='Compare the results against this stored baseline')
+parser.add_argument('--save-baseline', help='Store the results as a baseline in this file')
+parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+
+
+if __name__ == '__main__':
+  args    = parser.parse_args()
+  results = { 'created': time.time(), 'repeat': args.repeat, 'sizes': {} }
+
+  for count in args.sizes:
+    results['sizes'][str(count)] = run_isolated(count, args.repeat)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      results['comparison'] = compare(results, json.load(f))
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  report = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(report + "\n")
+  else:
+    print report
+
+  if any(change.get('regression') for change in results.get('comparison', [])):
+    sys.exit(1)
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # Author : Friedrich Seifts <fseifts@gmail.com>
 
-import pexpect, sys, datetime, argparse, time, os, fabric
+import pexpect, sys, datetime, argparse, time, os, re, fabric, imp
 from fabric.api import *
-from subprocess import call
+from subprocess import call, Popen, PIPE
+
+# the scheduler is loaded on its own rather than through the fabfile package, whose __init__ sets up
+# fab's env (roledefs, abort_on_prompts) and notifications for the fab tasks
+scheduler = imp.load_source('scheduler', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fabfile', 'scheduler.py'))
+Plan, warm_connection = scheduler.Plan, scheduler.warm_connection
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-e', '--lipsumenv', nargs='*', required=True, type=str, choices=['qa2', 'dev1', 'dev2', 'dev3'], help='Environments to perform restore operation, requires at least one environment to run')
@@ -14,7 +19,8 @@ currenttime   = datetime.datetime.now()
 array         = "vnx.nyc.lipsum.com"
 seckey        = "/opt/Navisphere/seckey"
 sqlinit       = "/etc/mysql/init.sql"
-navibin       = "/opt/Navisphere/bin/naviseccli"
+sqlinitcnf    = "/etc/mysql/conf.d/zz-envrestore-init.cnf"  # has the service's own boot run sqlinit
+navibin       = os.environ.get('NAVISECCLI', "/opt/Navisphere/bin/naviseccli")
 lipsumenv       = parser.parse_args().lipsumenv
 debugset      = parser.parse_args().debug
 env.warn_only = parser.parse_args().warn_only
@@ -22,7 +28,10 @@ dbhosts       = ['mongo01', 'mysql01']
 fehosts       = ['web01', 'php01']
 domain        = "lipsum.com"
 env.user      = "envrestore"
-sleeptime     = {'high' : 15, 'medium': 10, 'low' : 5}
+readiness     = {'destroy' : 180, 'create' : 180, 'attach' : 120, 'data' : 120, 'php' : 60}  # per-phase timeouts (seconds)
+service_ports = {'php' : 9000}
+snap_buffers  = ["%s-%s-snap", "%s-%s-snap-alt"]  # a host's snapshot alternates between these, see fabfile/snapshot.py
+limits        = {'array' : 4, 'ssh' : 16, 'host' : 1}  # restore steps allowed to use each resource at once (host is per host)
 line          = "-" * 50
 mongo_hosts   = []
 mysql_hosts   = []
@@ -77,6 +86,51 @@ smp_dict = {
 # !! DO NOT CHANGE IDs !!
 
 
+def wait_for(description, check, timeout, interval=0.25, max_interval=5):
+  start    = time.time()
+  deadline = start + timeout
+  while not check():
+    if time.time() >= deadline:
+      print "Timed out after %d seconds waiting for %s" % (timeout, description)
+      if env.warn_only != True:
+        sys.exit(1)
+      return
+    time.sleep(min(interval, max(deadline - time.time(), 0)))
+    interval = min(interval * 2, max_interval)
+  print "%s ready after %.1f seconds" % (description, time.time() - start)
+
+
+def snap_detail(snap=""):
+  child = Popen("%(a)s -secfilepath %(b)s -h %(c)s snap -list -id %(d)s -detail" % {'a':navibin, 'b':seckey, 'c':array, 'd':snap}, shell=True, stdout=PIPE, stderr=PIPE)
+  output = child.communicate()[0]
+  return output if child.returncode == 0 else None
+
+
+def snap_exists(snap=""):
+  return snap_detail(snap=snap) is not None
+
+
+def snap_attached(snap="", lunid=""):
+  output = snap_detail(snap=snap) or ""
+  attached = re.search('^\s*Attached LUN\(s\)\s*:\s*(.*)$', output, re.M)
+  return attached is not None and str(lunid) in re.split('[\s,]+', attached.group(1))
+
+
+def active_snap(env="", host=""):
+  # after a standby swap by the fab tasks it's -snap-alt that is attached to the SMP: restore that one, and leave
+  # the other (the standby) alone
+  buffers = [buffer % (host, env) for buffer in snap_buffers]
+  lunid   = smp_lunid(env=env, host=host)
+  return ([snap for snap in buffers if snap_attached(snap=snap, lunid=lunid)] or buffers)[0]
+
+
+def smp_lunid(env="", host=""):
+  if "mysql" in host:
+    return smp_dict['mysql_%ssmp_lunid' % env]
+  elif "mongo" in host:
+    return smp_dict['mongo_%ssmp_lunid' % env]
+
+
 def run_time():
   global runtime
   runtime = datetime.datetime.now()
@@ -105,47 +159,91 @@ def gen_fab_hosts():
   env.roledefs['php'] = php_hosts
 
 
-def delete_snap(env="", host=""):
-  child = pexpect.spawn('%(a)s -secfilepath %(b)s -h %(c)s snap -destroy -id %(d)s-%(e)s-snap' % {'a':navibin, 'b':seckey, 'c':array, 'd':host, 'e':env})
+def delete_snap(snap=""):
+  child = pexpect.spawn('%(a)s -secfilepath %(b)s -h %(c)s snap -destroy -id %(d)s' % {'a':navibin, 'b':seckey, 'c':array, 'd':snap})
   child.expect('Are you sure you want to perform this operation\?\(y\/n\):')
   child.sendline('y')
   child.sendcontrol('m')
 
 
-def create_snap(env="", host="", lunid=""):
-  os.system("%(a)s -secfilepath %(b)s -h %(c)s snap -create -res %(d)s -name %(e)s-%(f)s-snap -allowReadWrite yes" % {'a':navibin, 'b':seckey, 'c':array, 'd':lunid, 'e':host, 'f':env})
+def create_snap(snap="", lunid=""):
+  os.system("%(a)s -secfilepath %(b)s -h %(c)s snap -create -res %(d)s -name %(e)s -allowReadWrite yes" % {'a':navibin, 'b':seckey, 'c':array, 'd':lunid, 'e':snap})
 
 
-def smp_ops(env="", host="", lunid="", smpaction=""):
-  os.system("%(a)s -secfilepath %(b)s -h %(c)s snap -%(d)s -id %(e)s-%(f)s-snap -res %(g)s" % {'a':navibin, 'b':seckey, 'c':array, 'd':smpaction, 'e':host, 'f':env, 'g':lunid})
+def smp_ops(snap="", lunid="", smpaction=""):
+  os.system("%(a)s -secfilepath %(b)s -h %(c)s snap -%(d)s -id %(e)s -res %(f)s" % {'a':navibin, 'b':seckey, 'c':array, 'd':smpaction, 'e':snap, 'f':lunid})
 
 
-def run_delete_snap():
-  print "Destroying block level snapshots"
-  for e in lipsumenv:
-    for h in dbhosts:
-      delete_snap(env=e, host=h)
-  print "Destroy block level snapshots completed"
+def db_bootstrap(env="", host="", action=""):
+  bootstrap = mysql_env_bootstrap if "mysql" in host else mongo_env_bootstrap
+  execute(bootstrap, action=action, hosts=["%s.%s.%s" % (host, env, domain)])
 
 
-def run_create_snap():
-  print "Creating block level snapshots"
-  for e in lipsumenv:
-    for h in dbhosts:
-      if "mysql" in h:
-        create_snap(env=e, host=h, lunid=mysql_plunid)
-      elif "mongo" in h:
-        create_snap(env=e, host=h, lunid=mongo_plunid)
-  print "Creation of block level snapshots completed"
+def stop_db(env="", host=""):
+  db_bootstrap(env=env, host=host, action="stop")
+
+
+def detach_snap(env="", host="", snap=""):
+  smp_ops(snap=snap, lunid=smp_lunid(env=env, host=host), smpaction="detach")
+
+
+def destroy_snap(env="", host="", snap=""):
+  delete_snap(snap=snap)
+  wait_for("%s destroyed" % snap, lambda: not snap_exists(snap=snap), readiness['destroy'])
+
 
+def recreate_snap(env="", host="", snap=""):
+  create_snap(snap=snap, lunid=mysql_plunid if "mysql" in host else mongo_plunid)
+  wait_for("%s created" % snap, lambda: snap_exists(snap=snap), readiness['create'])
 
-def run_smp_ops(smpaction=""):
+
+def attach_snap(env="", host="", snap=""):
+  smp_ops(snap=snap, lunid=smp_lunid(env=env, host=host), smpaction="attach")
+  wait_for("%s attached" % snap, lambda: snap_attached(snap=snap, lunid=smp_lunid(env=env, host=host)), readiness['attach'])
+
+
+def start_db(env="", host=""):
+  # the bootstrap only returns once the database answers a ping
+  db_bootstrap(env=env, host=host, action="start")
+
+
+def restart_php(host=""):
+  execute(phprestart, hosts=[host])
+  execute(phpready, hosts=[host])
+
+
+def restart_web(host=""):
+  execute(webrestart, hosts=[host])
+
+
+def restore_plan():
+  # every database host goes through its own stop -> detach -> destroy -> create -> attach -> start chain, and
+  # start always runs so a failed step doesn't leave the database down; php restarts once every database is
+  # back on its new snapshot, and web once php is; the steps on a host share a worker process, which opens its ssh
+  # connection early (within the ssh limit) and keeps it for all of them
+  plan     = Plan(limits)
+  for host in mongo_hosts + mysql_hosts + php_hosts + web_hosts:
+    plan.warm('host:%s' % host, warm_connection, (host,), resources=['ssh'])
+  attached = []
+  started  = []
   for e in lipsumenv:
     for h in dbhosts:
-      if "mysql" in h:
-        smp_ops(env=e, host=h, lunid=smp_dict['mysql_%ssmp_lunid' % e], smpaction=smpaction)
-      elif "mongo" in h:
-        smp_ops(env=e, host=h, lunid=smp_dict['mongo_%ssmp_lunid' % e], smpaction=smpaction)
+      node = "%s.%s" % (h, e)
+      fqdn = "%s.%s" % (node, domain)
+      args = {'env' : e, 'host' : h}
+      snap = dict(args, snap=active_snap(env=e, host=h))
+      step = plan.add("%s stop" % node, stop_db, kwargs=args, resources=['ssh', 'host:%s' % fqdn], worker='host:%s' % fqdn)
+      step = plan.add("%s detach" % node, detach_snap, kwargs=snap, after=[step], resources=['array'])
+      step = plan.add("%s destroy" % node, destroy_snap, kwargs=snap, after=[step], resources=['array'])
+      step = plan.add("%s create" % node, recreate_snap, kwargs=snap, after=[step], resources=['array'])
+      step = plan.add("%s attach" % node, attach_snap, kwargs=snap, after=[step], resources=['array'])
+      attached.append(step)
+      started.append(plan.add("%s start" % node, start_db, kwargs=args, after=[step], resources=['ssh', 'host:%s' % fqdn], always=True, worker='host:%s' % fqdn))
+
+  php = [plan.add("%s restart" % host, restart_php, kwargs={'host' : host}, after=attached + started, resources=['ssh', 'host:%s' % host], worker='host:%s' % host) for host in php_hosts]
+  for host in web_hosts:
+    plan.add("%s restart" % host, restart_web, kwargs={'host' : host}, after=php or attached + started, resources=['ssh', 'host:%s' % host], worker='host:%s' % host)
+  return plan
 
 
 @roles('php')
@@ -153,6 +251,12 @@ def phprestart():
     sudo('service php-fpm restart')
 
 
+@roles('php')
+def phpready():
+    # php-fpm usually only listens on the loopback interface, so probe it from the host itself
+    wait_for("php-fpm on %s" % env.host, lambda: sudo('(echo > /dev/tcp/127.0.0.1/%d) 2>/dev/null' % service_ports['php'], quiet=True).succeeded, readiness['php'], 0.1)
+
+
 @roles('web')
 def webrestart():
     sudo('service varnish restart')
@@ -181,6 +285,7 @@ def mongo_env_bootstrap(action=""):
 
     print "Starting mongod server process"
     sudo('service mongod start')
+    wait_for("mongod on %s" % env.host, lambda: sudo('mongo --quiet --eval \'quit(db.adminCommand({ ping: 1 }).ok && db.isMaster().ok ? 0 : 1)\'', quiet=True).succeeded, readiness['data'], 0.1)
   else:
     print "Invalid action defined for mongo bootstrap"
 
@@ -205,14 +310,13 @@ def mysql_env_bootstrap(action=""):
     print "Removing master.info replication file"
     sudo('rm -f /var/lib/mongo/master.info')
 
-    print "Setting mysql credentials for environment"
-    sudo('mysqld_safe --init-file=%s &' % (sqlinit))
-    time.sleep(sleeptime['high'])
-    sudo('rm -f /tmp/envrestore.sql')
-    sudo('pkill -9 mysql')
-
-    print "Starting mysql server process"
-    sudo('service mysql start')
+    print "Starting mysql server process, setting mysql credentials for environment as it boots"
+    sudo('printf \'[mysqld]\\ninit-file=%s\\n\' > %s' % (sqlinit, sqlinitcnf))
+    try:
+      sudo('service mysql start')
+      wait_for("mysqld on %s" % env.host, lambda: sudo('mysqladmin ping', quiet=True).succeeded, readiness['data'], 0.1)
+    finally:
+      sudo('rm -f %s /tmp/envrestore.sql' % (sqlinitcnf))
   else:
     print "Invalid action defined for mysql bootstrap"
 
@@ -225,32 +329,17 @@ print "Environment restore started at: %s" % (runtime)
 print line
 
 
-execute(mongo_env_bootstrap, action="stop")
-execute(mysql_env_bootstrap, action="stop")
-run_smp_ops(smpaction="detach")
-run_delete_snap()
-print "Maintain holding pattern for %d seconds, allowing array to process destroy task" % (sleeptime['high'])
-time.sleep(sleeptime['high'])
-
-
-run_create_snap()
-run_smp_ops(smpaction="attach")
-print "Maintain holding pattern for %d seconds, allowing array to process creation task" % (sleeptime['high'])
-time.sleep(sleeptime['high'])
-execute(mongo_env_bootstrap, action="start")
-execute(mysql_env_bootstrap, action="start")
-print "Maintain holding pattern for %d seconds, allowing data tier to come online before connecting web/php nodes" % (sleeptime['medium'])
-time.sleep(sleeptime['medium'])
-
-
-print "Restarting php"
-execute(phprestart)
-print "Maintain holding pattern for %d seconds, allowing php to come online before restarting web/php nodes" % (sleeptime['low'])
-time.sleep(sleeptime['low'])
-print "Restarting nginx, and varnish"
-execute(webrestart)
+plan = restore_plan()
+failures = plan.run()
+print line
+plan.report()
+for step in sorted(failures):
+  print "Restore step %s failed: %s" % (step, failures[step])
 
 
 run_time()
 print line
 print "Environment restore ended at: %s" % (runtime)
+
+if failures and env.warn_only != True:
+  sys.exit(1)
@@ -4,13 +4,33 @@ Examples:
   Restore the given environments:
     $ fab restore:envA,envB,envC
 
+  Restore up to three of the given environments at the same time:
+    $ fab restore:envA,envB,envC,parallel=3
+
+  Restore with at most one array operation at a time:
+    $ fab restore:envA,array=1
+
+  Restore by swapping in standby snapshots (after creating them ahead of the first such restore):
+    $ fab setenv:envA snapshot.standby_all
+    $ fab restore:envA,standby=yes
+
+  Restore even if the environment is still fresh from its last restore:
+    $ fab restore:envA,force=yes
+
   Simulate VNX operations:
     $ fab dry_run:on restore:envA
+
+  Restore against the naviseccli simulator instead of the array:
+    $ fab naviseccli:benchmarks/naviseccli_sim.py restore:envA
+
+  Record a trace of the restore (restore-trace.jsonl, plus restore-trace.json for a trace viewer):
+    $ fab trace:restore-trace restore:envA
 '''
 
 from fabric.api import env, task, runs_once, abort
+from fabric.colors import red
 from fabric.state import output
-import pprint
+import os, pprint, time
 
 # if we are in debug mode, make sure we are verbose with ssh logging too
 env.debugging = False
@@ -26,10 +46,19 @@ ENVIRONMENTS = {
   'laboratory'  : 'lab'
 }
 
+# hostname prefixes used to discover the servers for each role
+ROLE_PREFIXES = {
+  'mysql' : 'mysql',
+  'mongo' : 'mongo',
+  'web'   : 'web',
+  'php'   : 'php'
+}
+
 
 env.navisphere    =  {
   'sekkey' : '/opt/Navisphere/seckey',
-  'navibin': '/opt/Navisphere/bin/naviseccli'
+  'navibin': '/opt/Navisphere/bin/naviseccli',
+  'cli'    : '/usr/bin/sudo /opt/Navisphere/bin/naviseccli'
 }
 
 # settings
@@ -41,17 +70,49 @@ env.sql_initfile = "/etc/mysql/init.sql"
 
 env.lb_host   = 'www.lipsum.com'
 
+# servers are discovered by node index, from 1 up to (but not including) this one
+env.max_node_index = 5
+
+# how many restore steps may use each resource at once (see fabfile.scheduler); host limits apply per host
+env.restore_limits = { 'array': 4, 'ssh': 16, 'host': 1 }
+
+# recreate every database host's snapshot in one batch with a single wait, instead of per host
+env.restore_batch_array = True
+
+# naviseccli commands a batch runs at once (operations on the same snapshot or LUN still run in turn)
+env.array_batch_workers = 8
+
+# swap a standby snapshot (created after the previous restore) onto each database's SMP instead of
+# recreating its snapshot while the database is down; the data is as old as the standby
+env.restore_standby = False
+
+# skip restoring databases whose snapshot is younger than this (seconds) and hasn't been written to
+env.restore_fresh_for = 60 * 60
+env.restore_force     = False
+
 env.interact  = True
 env.benchmark = True
 env.dry_run   = False
+env.trace_file = None
+
+# benchmark history (every run's span durations, see benchmark_report)
+env.benchmark_history = os.path.expanduser('~/.envrestore/benchmark.db')
+env.run_id            = "%d.%d" % (time.time(), os.getpid())
 
 env.depp_on_update = True
 env.allow_update   = True
 env.abort_on_prompts = True
 
+# discovery cache (ttl is in seconds, 0 disables the cache)
+env.discovery_cache   = os.path.expanduser('~/.envrestore/discovery.json')
+env.discovery_ttl     = 24 * 60 * 60
+env.discovery_refresh = False
+
 # notifications
 env.notify_using = 'jabber' # jabber, irc, or all
 env.notify_mute  = []
+# seconds to wait for queued notifications to go out when fab exits
+env.notify_flush_timeout = 10
 
 # roles
 env.roledefs['mysql'] = []
@@ -67,6 +128,7 @@ import fabfile.mysql.tasks as mysql
 import fabfile.snapshot as snapshot
 import fabfile.services as services
 import fabfile.util as util
+import fabfile.history as history
 
 from fabfile.restore.tasks import restore
 
@@ -78,6 +140,31 @@ def benchmark(v='on'):
   '''
   env.benchmark = v.lower() in [ 'true', 'yes', 'on', '1' ]
 
+@task
+@runs_once
+def benchmark_report(days=30, environment=None):
+  '''
+  Shows p50/p95/max per phase over the last N days of benchmark history, flagging regressions
+  '''
+  stats = history.phase_stats(days, environment or env.env)
+  if not stats:
+    abort("No benchmark history recorded in the last %s days." % days)
+
+  print "\nBenchmark history for the last %s days (seconds):\n" % days
+  print "  %-6s %-48s %-32s %5s %8s %8s %8s %8s" % ('env', 'phase', 'host', 'runs', 'p50', 'p95', 'max', 'latest')
+  for phase in stats:
+    print "  %-6s %-48s %-32s %5d %8.1f %8.1f %8.1f %8.1f%s" % (
+      phase['environment'] or '-', phase['label'], (phase['host'] or '-').split('@')[-1], phase['samples'],
+      phase['p50'], phase['p95'], phase['max'], phase['latest'], red('  REGRESSED') if phase['regressed'] else '')
+
+@task
+@runs_once
+def trace(path='envrestore-trace'):
+  '''
+  Records benchmark spans to <path>.jsonl and a Chrome trace of them to <path>.json
+  '''
+  util.enable_tracing(path)
+
 @task
 @runs_once
 def dry_run(v='on'):
@@ -93,6 +180,14 @@ def status():
   '''
   # execute('lb.status')
 
+@task
+@runs_once
+def naviseccli(cli):
+  '''
+  Run array operations through the given naviseccli command (e.g. benchmarks/naviseccli_sim.py)
+  '''
+  env.navisphere['cli'] = cli
+
 @task
 @runs_once
 def runner(runner):
@@ -127,6 +222,26 @@ def list_servers(which='all'):
   for server in servers:
     print "\t%s" % server.split('@')[1]
 
+@task
+@runs_once
+def discovery(action='refresh', ttl=None):
+  '''
+  Rebuilds (refresh) or removes (clear) the cached servers of the current environment
+  '''
+  if ttl is not None:
+    env.discovery_ttl = int(ttl)
+
+  if action == 'clear':
+    util.clear_discovery_cache(env.env_short)
+  elif action == 'refresh':
+    if not env.env_short:
+      # no environment yet, so make the next setenv skip the cache
+      env.discovery_refresh = True
+    else:
+      env.roledefs.update(util.cached_discovery(ROLE_PREFIXES, max_node_index=env.max_node_index, refresh=True))
+  else:
+    abort("Invalid discovery action: must be one of 'refresh' or 'clear'")
+
 @task
 @runs_once
 def dump():
@@ -142,7 +257,5 @@ def setenv(name, short_name = None):
   # load balancer host
   env.lb_host     = '%s.lipsum.com' % env.env_short
 
-  env.roledefs['mysql'] = util.mysql_server_list(max_node_index=5)
-  env.roledefs['mongo'] = util.mongo_server_list(max_node_index=5)
-  env.roledefs['web']   = util.web_server_list(max_node_index=5)
-  env.roledefs['php']   = util.php_server_list(max_node_index=5)
+  # probe all roles at once rather than one role after another, serving from the cache if we can
+  env.roledefs.update(util.cached_discovery(ROLE_PREFIXES, max_node_index=env.max_node_index, refresh=env.discovery_refresh))
@@ -0,0 +1,118 @@
+from contextlib import closing
+from time import time
+import errno, math, os, sqlite3, threading
+
+from fabric.api import env, warn
+
+SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS spans (
+    run_id      TEXT NOT NULL,
+    recorded    REAL NOT NULL,
+    environment TEXT,
+    label       TEXT NOT NULL,
+    host        TEXT,
+    duration    REAL NOT NULL,
+    state       TEXT NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS spans_by_phase ON spans (environment, label, host, recorded);
+'''
+
+# a phase has regressed when its latest run took this much longer than its historical median
+REGRESSION_FACTOR = 1.25
+
+# and only once there is enough history to compare against
+MIN_HISTORY = 3
+
+def connect(path=None, check_same_thread=True):
+  path = path or env.benchmark_history
+  try:
+    os.makedirs(os.path.dirname(path))
+  except OSError, e:
+    if e.errno != errno.EEXIST: raise
+
+  # parallel tasks write from several processes, so wait for each other's locks
+  connection = sqlite3.connect(path, timeout=30, check_same_thread=check_same_thread)
+  connection.executescript(SCHEMA)
+  return connection
+
+# the connection record() writes through, opened (and the schema created) once per process
+_lock       = threading.Lock()
+_connection = None
+_pid        = None
+_path       = None
+
+def recorder():
+  '''This process's connection to env.benchmark_history, shared by the spans it records'''
+  global _connection, _pid, _path
+  # a forked (parallel) task must not share its parent's connection
+  if _pid != os.getpid() or _path != env.benchmark_history:
+    # spans finish on whichever thread ran them, and _lock keeps them from writing at once
+    _connection = connect(check_same_thread=False)
+    _pid, _path = os.getpid(), env.benchmark_history
+  return _connection
+
+def record(span):
+  '''Stores the duration of a finished benchmark span, keyed by environment, label and host'''
+  # dry runs skip the array and would only drag the history down
+  if not env.get('benchmark_history') or env.get('dry_run'):
+    return
+
+  try:
+    with _lock:
+      connection = recorder()
+      with connection:
+        connection.execute(
+          'INSERT INTO spans (run_id, recorded, environment, label, host, duration, state) VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (env.run_id, span['wall_start'], span['environment'], span['label'], span['host'], span['duration'], span['state']))
+  except sqlite3.Error, e:
+    # history is nice to have, never a reason to fail a restore
+    warn("Unable to record benchmark history in %s: %s" % (env.benchmark_history, e))
+    env.benchmark_history = None
+
+def percentile(values, p):
+  '''Nearest-rank percentile of the given values'''
+  values = sorted(values)
+  if not values:
+    return None
+  rank = int(math.ceil(p / 100.0 * len(values))) - 1
+  return values[min(max(rank, 0), len(values) - 1)]
+
+def phase_stats(days=30, environment=None, path=None):
+  '''
+  Summarizes the succeeded spans of the last `days` days for every (environment, label, host),
+  returning dicts with the sample count, p50, p95, max and latest duration, and whether the
+  latest run regressed against the ones before it.
+  '''
+  query  = 'SELECT environment, label, host, run_id, duration FROM spans WHERE state = ? AND recorded >= ?'
+  params = ['succeeded', time() - float(days) * 24 * 60 * 60]
+  if environment:
+    query += ' AND environment = ?'
+    params.append(environment)
+  query += ' ORDER BY recorded'
+
+  with closing(connect(path)) as connection:
+    rows = connection.execute(query, params).fetchall()
+
+  phases = {}
+  for environment, label, host, run_id, duration in rows:
+    phases.setdefault((environment, label, host), []).append((run_id, duration))
+
+  stats = []
+  for (environment, label, host), samples in sorted(phases.items()):
+    durations = [duration for run_id, duration in samples]
+    latest    = samples[-1]
+    history   = [duration for run_id, duration in samples if run_id != latest[0]]
+    median    = percentile(history, 50)
+
+    stats.append({
+      'environment': environment,
+      'label':       label,
+      'host':        host,
+      'samples':     len(durations),
+      'p50':         percentile(durations, 50),
+      'p95':         percentile(durations, 95),
+      'max':         max(durations),
+      'latest':      latest[1],
+      'regressed':   len(history) >= MIN_HISTORY and latest[1] > median * REGRESSION_FACTOR
+    })
+  return stats
@@ -1,31 +1,93 @@
 from contextlib import contextmanager, nested
-from fabric.api import sudo, settings, task, roles, execute, puts, hide, settings, abort, env
-from fabfile.util import benchmark
+import re
+from fabric.api import sudo, settings, task, roles, execute, puts, hide, settings, abort, env, parallel
+from fabfile.util import benchmark, release_mount, record_timing
 
-__all__ = [ 'restore' ]
+__all__ = [ 'restore', 'stop', 'start', 'ready', 'writes' ]
+
+# seconds to wait for the server to answer, journal replay included
+READY_TIMEOUT = 120
+
+# waits until mongod accepts connections and answers a ping and isMaster (a listening port alone
+# can still refuse queries while it recovers), and prints the milliseconds that took
+READY = '''
+  start=$(date +%%s%%N); deadline=$((start + %(seconds)d * 1000000000));
+  until mongo --quiet --eval 'quit(db.adminCommand({ ping: 1 }).ok && db.isMaster().ok ? 0 : 1)' >/dev/null 2>&1; do
+    [ $(date +%%s%%N) -ge $deadline ] && exit 2;
+    sleep %(interval)s;
+  done;
+  echo "ready $(( ($(date +%%s%%N) - start) / 1000000 ))"
+'''
+
+def wait_until_ready(seconds=READY_TIMEOUT, interval=0.1):
+  '''
+  Polls mongod on the current host every interval seconds until it answers (see READY), records
+  how long that took on the current benchmark span and returns it. Aborts after the given number
+  of seconds.
+  '''
+  with settings(hide('output', 'running', 'warnings'), warn_only=True):
+    result = sudo(READY % { 'seconds': seconds, 'interval': interval })
+
+  if result.failed:
+    abort("MongoD on %s wasn't accepting connections after %ds" % (env.host_string, seconds))
+
+  ready = re.search(r'ready (\d+)', result)
+  if not ready:
+    return None
+  elapsed = int(ready.group(1)) / 1000.0
+  record_timing('ready', elapsed)
+  puts("MongoD ready after %.2fs" % elapsed)
+  return elapsed
+
+@task
+@roles('mongo')
+def stop():
+  '''Stops MongoD and unmounts its data directory'''
+  with benchmark('mongo_stop'):
+    puts('Waiting for MongoD to finish shutting down...')
+    release_mount('/var/lib/mongo')
+
+@task
+@roles('mongo')
+def start():
+  '''Mounts the data directory and starts MongoD, returning once it answers queries'''
+  with benchmark('mongo_start'):
+    sudo('mount /dev/sdb1 /var/lib/mongo')
+    sudo('rm -rf /var/lib/mongo/mongod.lock /var/lib/mongo/journal')
+    sudo('service mongod start')
+    puts('Waiting for MongoD to accept connections...')
+    wait_until_ready()
+
+@task
+@parallel
+@roles('mongo')
+def ready(seconds=READY_TIMEOUT):
+  '''Waits until MongoD answers queries on every mongo host'''
+  with benchmark('mongo_ready'):
+    wait_until_ready(int(seconds))
+
+@task
+@parallel
+@roles('mongo')
+def writes():
+  '''Returns how long MongoD has been up (seconds) and the writes it has served since, or None'''
+  with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+    result = sudo("""mongo --quiet --eval 'var s = db.serverStatus(), o = s.opcounters; print(s.uptime + " " + (o.insert + o.update + o.delete))'""")
+  if result.failed:
+    return None
+  try:
+    uptime, count = result.split()[-2:]
+    return int(float(uptime)), int(float(count))
+  except ValueError:
+    return None
 
 @contextmanager
 def mongo():
   try:
-    with benchmark('mongo_stop'):
-      puts('Waiting for MongoD to finish shutting down...')
-      with nested(hide('output','running','warnings'), settings(warn_only=True)):
-        sudo("""
-          seconds=30;
-          while [ $seconds -gt 0 ]; do
-            lsof -t /var/lib/mongo &>- && for p in $(lsof -t /var/lib/mongo); do kill -9 $p; done || exit 0;
-            sleep 1;
-            seconds=$((seconds - 1));
-          done;
-          exit 2
-        """)
-      sudo('umount /var/lib/mongo')
-      yield
+    stop()
+    yield
   finally:
-    with benchmark('mongo_start'):
-      sudo('mount /dev/sdb1 /var/lib/mongo')
-      sudo('rm -rf /var/lib/mongo/mongod.lock /var/lib/mongo/journal')
-      sudo('service mongod start')
+    start()
 
 @task
 @roles('mongo')
@@ -1,44 +1,81 @@
 from contextlib import contextmanager, nested
-from fabric.api import sudo, task, roles, execute, puts, hide, settings, abort, env
-from fabfile.util import benchmark
+import re
+from fabric.api import sudo, task, roles, execute, puts, hide, settings, abort, env, parallel
+from fabfile.util import benchmark, release_mount, record_timing
 
-__all__ = [ 'restore' ]
+__all__ = [ 'restore', 'stop', 'start', 'writes' ]
+
+# option file that has the service's own boot apply the credentials in init.sql (init-file runs
+# before the server accepts connections), so there is no separate boot just to reset them
+INIT_CNF = '/etc/mysql/conf.d/zz-envrestore-init.cnf'
+
+# seconds to wait for the server to answer on its socket, crash recovery included
+READY_TIMEOUT = 120
+
+# starts mysqld through the service manager with INIT_CNF in place, waits until it answers a ping
+# on its socket, and prints the milliseconds that took
+START = '''
+  printf '[mysqld]\\ninit-file=%(init_file)s\\n' > %(cnf)s;
+  start=$(date +%%s%%N); deadline=$((start + %(seconds)d * 1000000000));
+  service mysql start || { rc=$?; rm -f %(cnf)s; exit $rc; };
+  until mysqladmin ping >/dev/null 2>&1; do
+    [ $(date +%%s%%N) -ge $deadline ] && { rm -f %(cnf)s; exit 2; };
+    sleep 0.1;
+  done;
+  rm -f %(cnf)s;
+  echo "ready $(( ($(date +%%s%%N) - start) / 1000000 ))"
+'''
+
+@task
+@roles('mysql')
+def stop():
+  '''Stops MySQLD and unmounts its data directory'''
+  with benchmark('mysql_stop'):
+    puts('Waiting for MySQLD to finish shutting down...')
+    release_mount('/var/lib/mysql')
+
+@task
+@roles('mysql')
+def start(init_file='/etc/mysql/init.sql'):
+  '''Mounts the data directory and starts MySQLD, resetting the credentials as it boots'''
+  with benchmark('mysql_start'):
+    sudo('mount /dev/sdb1 /var/lib/mysql')
+    sudo('rm -f /var/lib/mongo/master.info')
+    puts('Waiting for MySQLD to finish initializing...')
+    with nested(hide('output','running','warnings'), settings(warn_only=True)):
+      result = sudo(START % { 'init_file': init_file, 'cnf': INIT_CNF, 'seconds': READY_TIMEOUT })
+
+    if result.failed:
+      abort("MySQLD %s on %s" % ("didn't start" if result.return_code != 2 else
+        "wasn't accepting connections after %ds" % READY_TIMEOUT, env.host_string))
+
+    ready = re.search(r'ready (\d+)', result)
+    if ready:
+      record_timing('ready', int(ready.group(1)) / 1000.0)
+      puts("MySQLD ready after %.2fs" % (int(ready.group(1)) / 1000.0))
+
+@task
+@parallel
+@roles('mysql')
+def writes():
+  '''Returns how long MySQLD has been up (seconds) and the InnoDB rows it has written since, or None'''
+  with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+    result = sudo("""mysql -N -B -e "SHOW GLOBAL STATUS WHERE Variable_name IN ('Uptime', 'Innodb_rows_inserted', 'Innodb_rows_updated', 'Innodb_rows_deleted')" """)
+  if result.failed:
+    return None
+  status = dict(line.split() for line in result.splitlines() if len(line.split()) == 2)
+  try:
+    return int(status['Uptime']), sum(int(status[name]) for name in ('Innodb_rows_inserted', 'Innodb_rows_updated', 'Innodb_rows_deleted'))
+  except (KeyError, ValueError):
+    return None
 
 @contextmanager
 def mysql(init_file='/etc/mysql/init.sql'):
   try:
-    with benchmark('mysql_stop'):
-      with nested(hide('output','running','warnings'), settings(warn_only=True)):
-        puts('Waiting for MySQLD to finish shutting down...')
-        sudo("""
-          seconds=30;
-          while [ $seconds -gt 0 ]; do
-            lsof -t /var/lib/mysql &>- && for p in $(lsof -t /var/lib/mysql); do kill -9 $p; done || exit 0;
-            sleep 1;
-            seconds=$((seconds - 1));
-          done;
-          exit 2
-        """)
-      sudo('umount /var/lib/mysql')
-      yield
+    stop()
+    yield
   finally:
-    with benchmark('mysql_start'):
-      sudo('mount /dev/sdb1 /var/lib/mysql')
-      sudo('rm -f /var/lib/mongo/master.info')
-      sudo('nohup mysqld --init-file=%s &>/tmp/reinit.log &' % (init_file))
-      puts('Waiting for MySQLD to finish initializing...')
-      with nested(hide('output','running','warnings'), settings(warn_only=True)):
-        sudo("""
-          seconds=30;
-          while [ $seconds -gt 0 ]; do
-            grep -qP "^Version.+socket:.+port:.+" /tmp/reinit.log && pkill -9 mysql && exit 0;
-            grep -qP "(Aborting|Starting shutdown)" /tmp/reinit.log && exit 1;
-            sleep 1;
-            seconds=$((seconds - 1));
-          done;
-          exit 2
-        """)
-      sudo('service mysql start')
+    start(init_file)
 
 @task
 @roles('mysql')
@@ -1,14 +1,13 @@
 from fabric.api import env
-from fabfile.notify import jabber, irc
+from fabfile.notify import jabber, irc, outbox
 
 def announce(message, method = 'announce'):
+    '''Queues the message for every selected service (see outbox), without waiting for it to be sent'''
     types = { 'jabber': jabber, 'irc': irc }
     for _type, adapter in types.iteritems():
         if _type in env.notify_mute: continue
         if env.notify_using in [ _type, 'all' ]:
-            _method = getattr(adapter.new(), method)
-            if callable(_method) and not _type in env.notify_mute:
-                _method(message)
+            outbox.post(_type, adapter, method, message)
 
 def broad_announce(message):
     announce(message, 'broad_announce')
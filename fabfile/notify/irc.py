@@ -1,5 +1,4 @@
-import socket, time
-from fabfile.timeout import attempt_or_warn
+import os, socket, sys, traceback
 from fabric.api import env, warn
 
 def new(*args):
@@ -12,14 +11,18 @@ def error_handler(*args):
   else:
     warn("Disabling IRC notifications.")
 
-class IRC:
+class IRC(object):
   HOST     = "irc.lipsum.com"
   PORT     = 6667
   NICK     = "DeployBotDeux"
   IDENT    = "DeployBotDeux"
   REALNAME = "DeployBotDeux"
 
+  # seconds to connect and register, or to send
+  TIMEOUT  = 5
+
   _instance = None
+  _pid      = None
 
   DEPLOY_CHANNELS = ['#deploy']
   SYSOP_CHANNELS  = ['#sysops']
@@ -27,36 +30,63 @@ class IRC:
   TEST_CHANNEL    = ['#test']
 
   def __new__(cls, *args):
-    if not cls._instance:
+    # a forked process gets an instance (and connection) of its own rather than its parent's
+    if not cls._instance or cls._pid != os.getpid():
       cls._instance = super(IRC, cls).__new__(cls, *args)
+      cls._pid      = os.getpid()
     return cls._instance
 
   def __init__(self):
-    self.__setup()
+    # the connection (and the channels joined on it) lasts as long as the instance
+    if not hasattr(self, 'irc'):
+      self.irc    = None
+      self.joined = set()
 
   def __setup(self):
-    with attempt_or_warn(5, timeout_handler = error_handler, exception_handler = error_handler):
-      self.irc = socket.socket ( socket.AF_INET, socket.SOCK_STREAM )
-      self.irc.connect((self.HOST, self.PORT))
-      self.irc.send("NICK %s\r\n" % self.NICK)
-      self.irc.send("USER %s %s bla :%s\r\n" % (self.IDENT, self.HOST, self.REALNAME))
+    self.irc    = socket.create_connection((self.HOST, self.PORT), self.TIMEOUT)
+    self.joined = set()
+    self.irc.sendall("NICK %s\r\n" % self.NICK)
+    self.irc.sendall("USER %s %s bla :%s\r\n" % (self.IDENT, self.HOST, self.REALNAME))
+    self.__wait_for_welcome()
 
-  def __send(self,msg):
-    try:
-      self.irc.send(msg)
-    except socket.error:
+  def __wait_for_welcome(self):
+    '''Reads until the server has registered us (001), as it only lets us JOIN after that'''
+    pending = ''
+    while True:
+      data = self.irc.recv(4096)
+      if not data:
+        raise socket.error("connection closed while registering")
+      lines   = (pending + data).split("\r\n")
+      pending = lines.pop()
+      for line in lines:
+        if line.startswith("PING "):
+          self.irc.sendall("PONG %s\r\n" % line[5:])
+        elif len(line.split()) > 1 and line.split()[1] == '001':
+          return
+
+  def __send(self, channel, message):
+    if self.irc is None:
       self.__setup()
-      self.irc.send(msg)
+    if channel not in self.joined:
+      self.irc.sendall("JOIN :%s\r\n" % channel)
+      self.joined.add(channel)
+    self.irc.sendall("PRIVMSG %s :%s\r\n" % (channel, message))
 
   def announce(self, message, channels=None):
-    with attempt_or_warn(5, timeout_handler = error_handler, exception_handler = error_handler):
-      if channels == None:
-        channels = self.SYSOP_CHANNELS
+    if channels == None:
+      channels = self.SYSOP_CHANNELS
 
+    try:
       for channel in channels:
-        self.__send("JOIN :%s\r\n" % channel)
-        time.sleep(1)
-        self.__send("PRIVMSG %s :%s\r\n" % (channel, message))
+        try:
+          self.__send(channel, message)
+        except socket.error:
+          # the server dropped us since the last announcement: connect (and join) again
+          self.irc = None
+          self.__send(channel, message)
+    except Exception, e:
+      self.irc = None
+      error_handler(self.TIMEOUT, e, ''.join(traceback.format_tb(sys.exc_info()[2])))
 
   def broad_announce(self, message):
       self.announce(message, self.BROAD_CHANNELS)
@@ -1,7 +1,6 @@
 import xmpp, os
 from fabric.api import warn, env
 from random import randint
-from fabfile.timeout import attempt_or_warn
 
 class ConnectionError(Exception): pass
 class AuthorizationError(Exception): pass
@@ -16,12 +15,13 @@ def error_handler(*args):
   else:
     warn("Disabling Jabber notifications.")
 
-class Jabber():
+class Jabber(object):
 
     PASSWORD  = 'ENTER YOUR CREDS HERE'
     NICKNAME  = 'DeployBot'
 
     _instance = None
+    _pid      = None
 
     DEPLOY_CHANNELS = [ 'deploy@conference.lipsum.com' ]
     SYSOP_CHANNELS  = [ 'systems@conference.lipsum.com' ] + DEPLOY_CHANNELS
@@ -29,14 +29,20 @@ class Jabber():
     TEST_CHANNEL    = [ 'test@conference.lipsum.com' ]
 
     def __new__(cls, *args):
-        if not cls._instance:
+        # a forked process gets an instance (and connection) of its own rather than its parent's
+        if not cls._instance or cls._pid != os.getpid():
             cls._instance = super(Jabber, cls).__new__(cls, *args)
+            cls._pid      = os.getpid()
         return cls._instance
 
     def __init__(self):
+        # the connection (and the rooms joined on it) lasts as long as the instance
+        if hasattr(self, '_client'):
+            return
         self._jid       = xmpp.protocol.JID(self.jabber_id())
         self._client    = xmpp.Client(self._jid.getDomain(), debug=[]) # debug=['socket', 'bind', 'dispatcher'])
         self._connected = False
+        self._joined    = set()
 
     def jabber_id(self):
         return "deploybot@lipsum.com/deploy.%s.%d" % (os.getpid(), randint(111111, 999999))
@@ -46,22 +52,26 @@ class Jabber():
             self.__connect()
 
     def __connect(self):
-        with attempt_or_warn(5, timeout_handler = error_handler):
-            try:
-                result = self._client.connect()
-                if result is None:
-                    raise ConnectionError
+        # announcements are sent from a thread of their own (see outbox), where the SIGALRM based
+        # timeouts don't work; how long they can take is bounded by the flush at exit instead
+        try:
+            self._connected = False
+            self._joined    = set()
+
+            result = self._client.connect()
+            if result is None:
+                raise ConnectionError
 
-                result = self._client.auth(self._jid.getNode(), self.PASSWORD, resource = self._jid.getResource())
-                if result is None:
-                    raise AuthorizationError
+            result = self._client.auth(self._jid.getNode(), self.PASSWORD, resource = self._jid.getResource())
+            if result is None:
+                raise AuthorizationError
 
-                self._client.sendInitPresence(requestRoster=0)
+            self._client.sendInitPresence(requestRoster=0)
 
-                self._connected = True
+            self._connected = True
 
-            except Exception as e:
-                raise ConnectionError(e)
+        except Exception as e:
+            raise ConnectionError(e)
 
     def __send(self, to, msg):
         message = xmpp.protocol.Message(to, msg)
@@ -73,27 +83,29 @@ class Jabber():
         except:
             self.__connect() # try to connect again
             try:
+                self.__join(to)
                 self._client.send(message)
             except:
                 warn("Unable to send notification to %s" % to)
 
     def __join(self, channel):
         self.__connect_if_disconnected()
-        self._client.send(xmpp.Presence(to="{0}/{1}".format(channel, self.NICKNAME)))
+        if channel not in self._joined:
+            self._client.send(xmpp.Presence(to="{0}/{1}".format(channel, self.NICKNAME)))
+            self._joined.add(channel)
 
     def announce(self, message, channels=None):
-        with attempt_or_warn(5, timeout_handler = error_handler):
-            try:
-                if channels == None:
-                    channels = self.DEPLOY_CHANNELS
-
-                for channel in channels:
-                    self.__join(channel)
-                    self.__send(channel, message)
-            except (AuthorizationError, ConnectionError) as e:
-                warn("Unable to connect to jabber service. skipping jabber notifications...")
-                warn("Connection Error was %s" % e)
-                pass
+        try:
+            if channels == None:
+                channels = self.DEPLOY_CHANNELS
+
+            for channel in channels:
+                self.__join(channel)
+                self.__send(channel, message)
+        except (AuthorizationError, ConnectionError) as e:
+            warn("Unable to connect to jabber service. skipping jabber notifications...")
+            warn("Connection Error was %s" % e)
+            error_handler()
 
     def sysop_announce(self, message):
         self.announce(message, self.SYSOP_CHANNELS)
@@ -0,0 +1,76 @@
+'''
+Announcements are delivered in the background, so a slow or unreachable chat service never holds
+up the task that announces something. Every service (jabber, irc) gets a queue and a thread of its
+own, which keeps the service's connection open from one announcement to the next; the services
+are sent to at the same time, and each one's announcements go out in the order they were made.
+
+Whatever is still queued when the process exits is given up to env.notify_flush_timeout seconds
+to go out.
+'''
+
+import atexit, os, threading, time, Queue
+from multiprocessing.util import Finalize
+
+from fabric.api import env, warn
+
+_lock     = threading.Lock()
+_outboxes = {}
+_pid      = None
+_main_pid = os.getpid()
+
+class Outbox(object):
+    def __init__(self, name, adapter):
+        self.name    = name
+        self.adapter = adapter
+        self.queue   = Queue.Queue()
+        self.thread  = threading.Thread(target=self._deliver, name='notify.%s' % name)
+        # a service that hangs can't keep the process from exiting past the flush
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _deliver(self):
+        for method, message in iter(self.queue.get, None):
+            # muted since it was queued, e.g. after failing to connect
+            if self.name in env.notify_mute:
+                continue
+            try:
+                getattr(self.adapter.new(), method)(message)
+            except Exception, e:
+                warn("Unable to send %s notification: %s" % (self.name, e))
+
+def post(name, adapter, method, message):
+    '''Queues adapter.new().method(message) for the named service's thread, and returns right away'''
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            # threads don't survive a fork: a forked (parallel) task gets outboxes of its own, which
+            # multiprocessing flushes as the process ends (it skips atexit handlers)
+            if os.getpid() != _main_pid:
+                Finalize(None, flush, exitpriority=0)
+            _outboxes.clear()
+            _pid = os.getpid()
+        if name not in _outboxes:
+            _outboxes[name] = Outbox(name, adapter)
+        _outboxes[name].queue.put((method, message))
+
+def flush(timeout=None):
+    '''
+    Waits up to timeout seconds (env.notify_flush_timeout by default) for the announcements queued
+    by this process to go out, and stops the threads delivering them.
+    '''
+    timeout = env.notify_flush_timeout if timeout is None else timeout
+    with _lock:
+        if _pid != os.getpid():
+            return
+        outboxes = _outboxes.values()
+        _outboxes.clear()
+
+    deadline = time.time() + timeout
+    for outbox in outboxes:
+        outbox.queue.put(None)
+    for outbox in outboxes:
+        outbox.thread.join(max(deadline - time.time(), 0))
+        if outbox.thread.is_alive():
+            warn("Gave up on pending %s notifications after %ds" % (outbox.name, timeout))
+
+atexit.register(flush)
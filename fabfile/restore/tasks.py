@@ -1,24 +1,222 @@
 import re
+from time import time
 
-from fabric.api import task, runs_once, env
-from fabric.api import execute, sudo, abort, warn
+from fabric.api import task, runs_once, env, settings
+from fabric.api import execute, sudo, abort, warn, puts
+from fabric.network import to_dict
+from fabric.state import commands
+from fabric.task_utils import crawl
 
+from fabfile import snapshot
 from fabfile.notify import sysop_announce
-from fabfile.util import benchmark, runner, flatten
+from fabfile.scheduler import Plan, run_jobs, warm_connection
+from fabfile.util import benchmark, runner, flatten, environment_tag
 
 __all__ = [ ]
 
+# roles whose data is restored from a fresh snapshot of their primary LUN
+DATABASE_ROLES = [ 'mongo', 'mysql' ]
+
+# a database that started longer than this after its snapshot was created has been restarted since
+# the restore, which also restarted the write counters that tell us nothing has changed
+STARTED_WITHIN = 15 * 60
+
+# the plan step that prepares the standby snapshots for the next restore; its failure is only a warning
+STANDBY_STEP = "standby snapshots"
+
 def split_environments(*e):
   if len(e) == 0: return None
   return set(flatten( re.compile('\s*,\s*').split(','.join(e)) ))
 
+def hostname(host):
+  return re.sub('^[^@]+@', '', host)
+
+def run_on(task_name, host):
+  '''
+  Runs a task on one host in this process, even a @parallel one (which execute() would fork off),
+  so it uses the connection this process already has open to the host
+  '''
+  with settings(**to_dict(host)):
+    return crawl(task_name, commands).run()
+
+def fresh_hosts(hosts):
+  '''
+  The given database hosts that are still as their last restore left them: attached to a Ready
+  snapshot created less than env.restore_fresh_for seconds ago, running a database that started
+  right after that, and which has served no writes since it started.
+  '''
+  vnx      = snapshot.client()
+  objects  = snapshot.hosts_objects(hosts)
+  # the run's one full listing: one inherited from earlier in this process may predate a restore
+  attached = vnx.snapshot_attachments(vnx.get_snapshots(force=True))
+  now      = time()
+
+  created = {}
+  for host, (snapshot_name, _, _, mountpoint_lun_id, _) in zip(hosts, objects):
+    found = vnx.get_snapshot_by_name(snapshot_name)
+    if (found is not None and str(getattr(found, 'state', '')) == 'Ready' and found.created() is not None
+        and now - found.created() < env.restore_fresh_for and str(mountpoint_lun_id) in attached.get(snapshot_name, [])):
+      created[host] = found.created()
+
+  fresh = []
+  for role in DATABASE_ROLES:
+    # only ask the databases whose snapshots could still be fresh
+    candidates = [ host for host in env.roledefs[role] if host in created ]
+    counters   = execute('%s.writes' % role, hosts=candidates) if candidates else {}
+    for host in candidates:
+      if counters.get(host) is None:
+        continue
+      uptime, writes = counters[host]
+      if writes == 0 and created[host] <= now - uptime <= created[host] + STARTED_WITHIN:
+        fresh.append(host)
+  return fresh
+
+def stale_roles():
+  '''The database roles that need restoring: those with no hosts, or at least one host that isn't fresh'''
+  fresh = set(fresh_hosts([ host for role in DATABASE_ROLES for host in env.roledefs[role] ]))
+  stale = [ role for role in DATABASE_ROLES if not env.roledefs[role] or not set(env.roledefs[role]) <= fresh ]
+  for role in DATABASE_ROLES:
+    if role not in stale:
+      puts("%s%s is fresh (restored and not written to since), skipping it" % (environment_tag(), role))
+  return stale
+
+def require_database_hosts():
+  '''Aborts unless every database role has at least one host to restore'''
+  for role, name in (('mongo', 'Mongo'), ('mysql', 'MySQL')):
+    if not env.roledefs[role] or len(env.roledefs[role]) == 0:
+      abort("Unable to find %s server(s) to perform restore on - quitting!" % name)
+
+def restore_plan(limits=None, batch=None, standby=None, roles=None):
+  '''
+  The restore of the selected environment as a graph of steps. Each database host is stopped,
+  its snapshot detached, destroyed, created and attached again, and started; its start always
+  runs so a failed step never leaves the database down. php is restarted once every database is
+  back on its new snapshot, and web once php is.
+
+  With batch (env.restore_batch_array by default) the array work of every database host is one
+  step instead (see snapshot.recreate_hosts), which starts once every database is stopped and
+  waits on the array once for all of them rather than once per host.
+
+  With standby (env.restore_standby by default) that step only swaps each host's standby snapshot
+  onto its SMP, and once the services are back the snapshots it replaced are recreated as the
+  standbys for the next restore. Until every host has a standby, the snapshots are recreated in
+  one batch as usual and the standbys created afterwards.
+
+  Only the databases of the given roles (all of them by default) are restored.
+
+  The steps on a host run one after another in a worker process of their own, which opens its
+  ssh connection early (as the ssh limit allows) and keeps it for all of them.
+  '''
+  require_database_hosts()
+
+  batch   = env.restore_batch_array if batch is None else batch
+  standby = env.restore_standby if standby is None else standby
+  hosts   = [ (role, host) for role in roles or DATABASE_ROLES for host in env.roledefs[role] ]
+  plan    = Plan(limits or env.restore_limits)
+
+  def on_host(name, task_name, host, **kwargs):
+    worker = 'host:' + hostname(host)
+    return plan.add(name, run_on, (task_name, host), resources=['ssh', worker], worker=worker, **kwargs)
+
+  for host in [ host for role, host in hosts ] + env.roledefs['php'] + env.roledefs['web']:
+    plan.warm('host:' + hostname(host), warm_connection, (host,), resources=['ssh'])
+
+  swap = False
+  if standby:
+    missing = snapshot.missing_standbys([ host for role, host in hosts ])
+    if missing:
+      warn("No standby snapshot for %s yet, recreating snapshots instead" % ', '.join(hostname(host) for host in missing))
+    swap = not missing
+
+  if batch or standby:
+    stopped  = [ on_host("%s stop" % hostname(host), "%s.stop" % role, host) for role, host in hosts ]
+    if swap:
+      attached = [ plan.add("snapshots swap", snapshot.swap_all, [ host for role, host in hosts ],
+        after=stopped, resources=['array']) ]
+    else:
+      attached = [ plan.add("snapshots recreate", snapshot.recreate_all, [ host for role, host in hosts ],
+        after=stopped, resources=['array']) ]
+    started  = [ on_host("%s start" % hostname(host), "%s.start" % role, host, after=attached, always=True)
+      for role, host in hosts ]
+  else:
+    attached = []
+    started  = []
+    for (role, host), objects in zip(hosts, snapshot.hosts_objects([ host for role, host in hosts ])):
+      snapshot_name, _, _, _, lun_id = objects
+      targets = { 'hosts': [host] }
+      node    = hostname(host)
+
+      step = on_host("%s stop" % node, "%s.stop" % role, host)
+      step = plan.add("%s detach" % node, execute, ('snapshot.detach', snapshot_name), targets, after=[step], resources=['array'])
+      step = plan.add("%s destroy" % node, execute, ('snapshot.destroy', snapshot_name), targets, after=[step], resources=['array'])
+      step = plan.add("%s create" % node, execute, ('snapshot.create', lun_id, snapshot_name), targets, after=[step], resources=['array'])
+      step = plan.add("%s attach" % node, execute, ('snapshot.attach', snapshot_name), targets, after=[step], resources=['array'])
+      attached.append(step)
+      started.append(on_host("%s start" % node, "%s.start" % role, host, after=[step], always=True))
+
+  # services only restart on top of a complete restore
+  restarted = attached + started
+  for role, task_name in (('php', 'services.backend'), ('web', 'services.frontend')):
+    restarted = [ on_host("%s restart" % hostname(host), task_name, host, after=restarted)
+      for host in env.roledefs[role] ] or restarted
+
+  if standby:
+    # off the critical path: the services are already back when this starts
+    plan.add(STANDBY_STEP, snapshot.standby_all, [ host for role, host in hosts ], after=restarted, resources=['array'])
+  return plan
+
+def restore_environment(_env, limits=None):
+  '''Restores a single environment: select it, then run the restore plan'''
+  # sysop_announce("%s is restoring mysql/mongo in environment %s" % (runner(), _env))
+  execute('setenv', _env)
+
+  # an environment without databases is an error, not a fresh one
+  require_database_hosts()
+  roles = DATABASE_ROLES if env.restore_force else stale_roles()
+  if not roles:
+    puts("%sNothing to restore (use force=yes to restore anyway)" % environment_tag())
+    return
+
+  plan = restore_plan(limits, roles=roles)
+  failures = plan.run()
+  plan.report()
+  if STANDBY_STEP in failures:
+    # the environment is restored; only the next restore has to recreate its snapshots instead
+    warn("%sUnable to create the standby snapshots for the next restore: %s" % (environment_tag(), failures.pop(STANDBY_STEP)))
+  if failures:
+    abort("Unable to restore %s: %s" % (_env, ', '.join("%s (%s)" % (name, failures[name]) for name in sorted(failures))))
+
+def restore_in_parallel(_environ, pool_size, limits=None):
+  '''
+  Restores the given environments, up to pool_size at a time, returning a dict of failures. Each
+  restore starts processes of its own (its plan's steps, parallel tasks), so the environments run
+  in run_jobs' non-daemonic processes: multiprocessing.Pool's daemonic workers can't have children.
+  '''
+  return run_jobs([ (_env, restore_environment, (_env, limits)) for _env in sorted(_environ) ], pool_size)
+
 @task
 @runs_once
-def restore(*_environ):
+def restore(*_environ, **kwargs):
   '''
-  Restore the given environment(s)
+  Restore the given environment(s), e.g. restore:dev,qa,lab,parallel=3
+
+  The steps of each restore run concurrently up to env.restore_limits, which can be overridden
+  per run, e.g. restore:dev,array=1,host=1. batch=no gives every host its own array steps
+  instead of sharing one batch (env.restore_batch_array), and standby=yes swaps in pre-created
+  standby snapshots (env.restore_standby).
+
+  Databases that are still fresh from their last restore are skipped, unless force=yes
+  (env.restore_force).
   '''
   _environ = split_environments(*_environ)
+  parallel = int(kwargs.pop('parallel', 1))
+  if 'batch' in kwargs:
+    env.restore_batch_array = kwargs.pop('batch').lower() in [ 'true', 'yes', 'on', '1' ]
+  if 'standby' in kwargs:
+    env.restore_standby = kwargs.pop('standby').lower() in [ 'true', 'yes', 'on', '1' ]
+  if 'force' in kwargs:
+    env.restore_force = kwargs.pop('force').lower() in [ 'true', 'yes', 'on', '1' ]
+  limits   = dict(env.restore_limits, **dict((k, int(v)) for k, v in kwargs.items() if k in env.restore_limits))
 
   if not _environ or len(_environ) == 0:
     if not env.env:
@@ -28,8 +226,12 @@ def restore(*_environ):
       _environ = set([env.env])
 
   with benchmark('restore'):
-    for _env in _environ:
-      # sysop_announce("%s is restoring mysql/mongo in environment %s" % (runner(), _env))
-      execute('setenv', _env)
-      for task in [ 'mongo.restore', 'mysql.restore', 'services.restart' ]:
-        execute(task)
+    if parallel > 1 and len(_environ) > 1:
+      failures = restore_in_parallel(_environ, parallel, limits)
+      for _env in sorted(_environ):
+        puts("[%s] restore %s%s" % (_env, 'failed: ' if _env in failures else 'succeeded', failures.get(_env, '')))
+      if failures:
+        abort("Unable to restore environment(s): %s" % ', '.join(sorted(failures)))
+    else:
+      for _env in _environ:
+        restore_environment(_env, limits)
@@ -1,9 +1,21 @@
 import pprint
 import re
+import threading
+import time
+from contextlib import contextmanager
 
-from fabfile.util import local_command, volatile_command
+from fabric.api import env, hide, settings, abort
 
-__all__ = ['Lun', 'VnxConfig', 'VnxClient']
+from fabfile.timeout import wait_until
+from fabfile.util import local_command, volatile_command, stream_command, concurrently
+
+__all__ = ['Lun', 'VnxConfig', 'VnxClient', 'VnxOperation']
+
+RECORD_SEPARATOR   = re.compile('\n{2,}')
+LIST_SEPARATOR     = re.compile('[\s,]+')
+
+NON_WORD             = re.compile('[^\w]+')
+TRAILING_UNDERSCORES = re.compile('_+$')
 
 def convert_to_number(s):
   try:
@@ -15,10 +27,54 @@ def convert_to_number(s):
   except ValueError:
     raise TypeError('unable to convert non-numeric value to number')
 
-class SanObject:
+# raw property name (as printed by naviseccli) -> normalized attribute name
+_property_names = {}
+_property_lock  = threading.Lock()
+
+# marks the slot of a property a record doesn't have
+_MISSING = object()
+
+def normalize_property_name(propname):
+  '''Turns e.g. "User Capacity (GBs)" into "user_capacity_gbs", computing each name only once'''
+  try:
+    return _property_names[propname]
+  except KeyError:
+    name = NON_WORD.sub('_', propname)
+    name = TRAILING_UNDERSCORES.sub('', name).lower()
+    _property_names[propname] = name
+    return name
+
+def convert_value(value):
+  '''Converts a raw property value to a number or boolean when it looks like one'''
+  stripped = value.strip('%$')
+  if stripped[:1].isdigit() or stripped[:1] in ('-', '+', '.'):
+    try:
+      return convert_to_number(value)
+    except (TypeError, OverflowError):
+      pass
+
+  if value.lower() in ('true', 'false', 'yes', 'no'):
+    return False if value.lower() in ('false', 'no') else True
+  return value
+
+class SanObject(object):
   '''
   Represents a SAN object in a very simple form
+
+  Arrays list thousands of these with dozens of properties each, most of which are never read,
+  so rather than a __dict__ per record every class keeps one table mapping property names to
+  positions, and each record only holds a list of values in that order. Values are kept as the
+  raw strings naviseccli printed until first read, when they are converted (see convert_value).
   '''
+  __slots__ = ('_values', '_typed')
+
+  # property name -> position in _values, shared by every record of the class
+  _keys = {}
+
+  def __init__(self):
+    self._values = []
+    self._typed  = 0 # bitmask of the positions in _values that have already been converted
+
   def to_string(self):
     return "<%s name='%s'>" % (self.__class__.__name__, int(self.id), self.name, int(self.size))
 
@@ -34,26 +90,96 @@ class SanObject:
   def __setitem__(self, key, value):
     return setattr(self, key, value)
 
+  def __getattr__(self, name):
+    # only called for names that aren't slots or class attributes, i.e. properties
+    if name in SanObject.__slots__:
+      raise AttributeError(name)
+
+    position = self._keys.get(name)
+    values   = self._values
+    if position is None or position >= len(values) or values[position] is _MISSING:
+      raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+    value = values[position]
+    if not self._typed >> position & 1:
+      value = values[position] = convert_value(value)
+      self._typed |= 1 << position
+    return value
+
+  def __setattr__(self, name, value):
+    if name in SanObject.__slots__:
+      object.__setattr__(self, name, value)
+    else:
+      self._store(name, value, typed=True)
+
+  def _store(self, name, value, typed):
+    position = self._keys.get(name)
+    if position is None:
+      with _property_lock:
+        position = self._keys.setdefault(name, len(self._keys))
+
+    values = self._values
+    if position < len(values):
+      values[position] = value
+    else:
+      values.extend([_MISSING] * (position - len(values)))
+      values.append(value)
+
+    bit = 1 << position
+    if typed:
+      self._typed |= bit
+    elif self._typed & bit:
+      self._typed &= ~bit
+
   def properties(self):
-    return self.__dict__.items()
+    names = sorted(self._keys.items(), key=lambda item: item[1])
+    return [(name, getattr(self, name)) for name, position in names
+            if position < len(self._values) and self._values[position] is not _MISSING]
 
   def add_property(self, propname, value):
-    propname = re.sub('[^\w]+', '_', propname)
-    propname = re.sub('_+$', '', propname).lower()
+    return self._store(normalize_property_name(propname), value, typed=False)
 
+  def dump(self):
+    pprint.PrettyPrinter(indent=4, depth=3).pprint(dict(self.properties()))
+
+class Lun(SanObject):
+  __slots__ = ()
+  _keys     = {}
+
+class Snapshot(SanObject):
+  __slots__ = ()
+  _keys     = {}
+
+  CREATION_TIME_FORMAT = '%a %b %d %H:%M:%S %Y'
+
+  def created(self):
+    '''When the snapshot was created (seconds since the epoch), or None if the array didn't say'''
     try:
-      value = convert_to_number(value)
-    except TypeError:
-      if value.lower() in ('true', 'false', 'yes', 'no'):
-        value = False if value.lower() in ('false', 'no') else True
+      return time.mktime(time.strptime(str(self.creation_time), self.CREATION_TIME_FORMAT))
+    except (AttributeError, ValueError):
+      return None
 
-    return setattr(self, propname, value)
+class VnxOperation(object):
+  '''
+  A volatile array command queued in a VnxClient batch; filled in once the batch has run. resources
+  names the snapshots and LUNs it acts on, which orders it after the queued operations on them.
+  '''
+  def __init__(self, command, resources=()):
+    self.command     = command
+    self.resources   = frozenset(resources)
+    self.return_code = None
+    self.output      = ''
 
-  def dump(self):
-    pprint.PrettyPrinter(indent=4, depth=3).pprint(vars(self))
+  @property
+  def succeeded(self):
+    return self.return_code == 0
 
-class Lun(SanObject): pass
-class Snapshot(SanObject): pass
+  @property
+  def failed(self):
+    return self.return_code is not None and self.return_code != 0
+
+  def __repr__(self):
+    return "<%s command='%s' return_code=%s>" % (self.__class__.__name__, self.command, self.return_code)
 
 class VnxConfig:
   '''
@@ -115,11 +241,20 @@ class VnxClient(object):
     VNX implementation of the SANClient
     '''
     LUN_DELIMITER              = 'LOGICAL UNIT NUMBER'
+    ATTACHED_PROPERTY          = 'attached_lun_s'
+
+    # seconds to wait for the array to settle after destroying/creating/attaching a snapshot
+    SETTLE_TIMEOUT             = 180
+
+    # properties indexed as soon as the luns/snapshots are loaded
+    DEFAULT_INDEXES            = ('id', 'name')
 
     _config    = None
     _cmd_base  = []
     _luns      = []
     _snapshots = []
+    _batch     = None
+    _indexes   = None
 
     @property
     def config(self):
@@ -129,28 +264,42 @@ class VnxClient(object):
     def cmd_base(self):
       return self._cmd_base
 
+    def iter_luns(self):
+      '''Yields each Lun as soon as its record has been read from the array'''
+      command = self._build_command(['lun', '-list'])
+      for record in self._parse_object_list(stream_command(command)):
+        yield self._parse_lun_record(record)
+
+    def iter_snapshots(self):
+      '''Yields each Snapshot as soon as its record has been read from the array'''
+      command = self._build_command(['snap', '-list', '-detail'])
+      for record in self._parse_object_list(stream_command(command)):
+        yield self._parse_snapshot_record(record)
+
     def get_luns(self, force = False):
       '''Gets list of all Luns'''
       if force or len(self._luns) <= 0:
-        command = self._build_command(['lun', '-list'])
-        with local_command(command) as result:
-          self._luns = [self._parse_lun_record(record) for record in self._parse_object_list(result)]
+        self._luns = list(self.iter_luns())
+        self._rebuild_indexes('lun')
       return self._luns
     luns = property(fget = get_luns)
 
     def get_snapshots(self, force = False):
       '''Get list of all Snapshots'''
       if force or len(self._snapshots) <= 0:
-        command = self._build_command(['snap', '-list', '-detail'])
-        with local_command(command) as result:
-          self._snapshots = [self._parse_snapshot_record(record) for record in self._parse_object_list(result)]
+        self._snapshots = list(self.iter_snapshots())
+        self._rebuild_indexes('snapshot')
       return self._snapshots
     snapshots = property(fget = get_snapshots)
 
     def __init__(self, config=None):
-      self._config = config if config else VnxConfig()
-      self.get_luns(True)
-      self.get_snapshots(True)
+      self._config  = config if config else VnxConfig()
+      self._indexes = {
+        'lun':      dict((key, {}) for key in self.DEFAULT_INDEXES),
+        'snapshot': dict((key, {}) for key in self.DEFAULT_INDEXES)
+      }
+      # nothing is listed up front: the luns/snapshots are only loaded once something needs all
+      # of them, and until then single lookups are answered by targeted queries
 
     def __getitem__(self, id_or_name):
       try:
@@ -184,79 +333,294 @@ class VnxClient(object):
       return ' '.join(self._cmd_base + cmd)
 
     def _parse_object_list(self, output):
-      '''Constructs a list of objects from the given input string'''
-      for record in re.compile('\n{2,}').split(output):
+      '''
+      Splits the given output into records, yielding each record as a list of its lines. output
+      may be a string or any iterable of lines (e.g. a stream_command), in which case records are
+      yielded as soon as their terminating blank line has been read.
+      '''
+      if isinstance(output, basestring):
+        for record in RECORD_SEPARATOR.split(output):
+          yield record.splitlines()
+        return
+
+      record = []
+      for line in output:
+        if line.strip():
+          record.append(line)
+        elif record:
+          yield record
+          record = []
+      if record:
         yield record
 
+    def _record_lines(self, record):
+      lines = record.splitlines() if isinstance(record, basestring) else record
+      return [line.strip() for line in lines]
+
+    def _split_property(self, line):
+      '''Splits a "Name:  value" line at its first colon'''
+      name, separator, value = line.partition(':')
+      return name.rstrip(), value.lstrip()
+
     def _parse_lun_record(self, lun_record):
       lun = Lun()
-      for line in [l.strip() for l in lun_record.splitlines()]:
+      for line in self._record_lines(lun_record):
         if line.startswith(self.LUN_DELIMITER):
           lun.id = int(line.split(' ')[-1])
         else:
-          lun.add_property(*re.compile('\s*:\s*').split(line, 1))
+          lun.add_property(*self._split_property(line))
       return lun
 
     def _parse_snapshot_record(self, snapshot_record):
       snapshot = Snapshot()
-      for line in [l.strip() for l in snapshot_record.splitlines()]:
-        snapshot.add_property(*re.compile('\s*:\s*').split(line, 1))
+      for line in self._record_lines(snapshot_record):
+        snapshot.add_property(*self._split_property(line))
       return snapshot
 
+    def _records(self, kind):
+      return self._luns if kind == 'lun' else self._snapshots
+
+    def _load(self, kind):
+      '''The 'lun' or 'snapshot' records, listing them from the array if they haven't been yet'''
+      return self.get_luns() if kind == 'lun' else self.get_snapshots()
+
+    def _build_index(self, kind, key):
+      index = {}
+      for record in self._records(kind):
+        value = getattr(record, key, None)
+        if value is not None:
+          index.setdefault(value, []).append(record)
+      self._indexes[kind][key] = index
+
+    def _rebuild_indexes(self, kind):
+      for key in self._indexes[kind]:
+        self._build_index(kind, key)
+
+    def add_index(self, kind, key):
+      '''
+      Adds a secondary index on the given property (e.g. primary_lun_s) of the 'lun' or 'snapshot'
+      records, making find_by lookups on it constant time. Indexes are kept up to date whenever
+      the records are reloaded. The records are loaded first if they haven't been yet.
+      '''
+      self._load(kind)
+      if key not in self._indexes[kind]:
+        self._build_index(kind, key)
+
+    def find_by(self, kind, key, value):
+      '''
+      Returns every 'lun' or 'snapshot' record whose property key equals value, loading the records
+      first if they haven't been yet
+      '''
+      records = self._load(kind)
+      if key in self._indexes[kind]:
+        return list(self._indexes[kind][key].get(value, []))
+      return [record for record in records if getattr(record, key, None) == value]
+
+    def find_first(self, kind, key, value):
+      '''Returns the first 'lun' or 'snapshot' record whose property key equals value, or None'''
+      found = self.find_by(kind, key, value)
+      return found[0] if found else None
+
     def _find_lun_by_property_key_and_value(self, key, value):
-      for record in self._luns:
-        for k, v in record.properties():
-          if (k,v) == (key, value):
-            return record
-      return None
+      return self.find_first('lun', key, value)
 
     def _find_snapshot_by_property_key_and_value(self, key, value):
-      for record in self._snapshots:
-        for k, v in record.properties():
-          if (k,v) == (key, value):
-            return record
-      return None
+      return self.find_first('snapshot', key, value)
 
     def get_lun_by_id(self, lun_id, direct=False):
-      if not direct:
+      '''
+      Looks the lun up in the loaded luns, or asks the array for just that lun if they haven't
+      been loaded (or direct is set). Returns None if there is no such lun.
+      '''
+      if not direct and len(self._luns) > 0:
         return self._find_lun_by_property_key_and_value('id', lun_id)
 
-      command = self._build_command(['lun', '-list', '-id', str(lun_id)])
-      with local_command(command) as result:
-        return self._parse_lun_record(result.strip())
+      result = self._query(['lun', '-list', '-id', str(lun_id)])
+      return self._parse_lun_record(result.strip()) if result else None
 
     def get_lun_by_name(self, lun_name, direct=False):
-      if not direct:
+      '''See get_lun_by_id'''
+      if not direct and len(self._luns) > 0:
         return self._find_lun_by_property_key_and_value('name', lun_name)
 
-      command = self._build_command(['lun', '-list', '-name', str(lun_name)])
-      with local_command(command) as result:
-        return self._parse_lun_record(result.strip())
+      result = self._query(['lun', '-list', '-name', str(lun_name)])
+      return self._parse_lun_record(result.strip()) if result else None
 
     def get_snapshot_by_name(self, snapshot_name, direct=False):
-      if not direct:
+      '''See get_lun_by_id'''
+      if not direct and len(self._snapshots) > 0:
         return self._find_snapshot_by_property_key_and_value('name', snapshot_name)
 
-      command = self._build_command(['snap', '-list', '-id', str(snapshot_name)])
-      with local_command(command) as result:
-        return self._parse_snapshot_record(result.strip())
+      result = self._query(['snap', '-list', '-id', str(snapshot_name), '-detail'])
+      return self._parse_snapshot_record(result.strip()) if result else None
+
+    def _query(self, cmd):
+      '''Runs a read-only command, returning its output or None if it failed (e.g. no such object)'''
+      with settings(hide('running', 'warnings', 'stdout', 'stderr'), warn_only=True):
+        with local_command(self._build_command(cmd)) as result:
+          return result if result.succeeded else None
+
+    def snapshot_exists(self, snapshot_name):
+      '''Asks the array whether the given snapshot currently exists'''
+      result = self._query(['snap', '-list', '-id', str(snapshot_name)])
+      return result is not None and len(result.strip()) > 0
+
+    def snapshot_attached(self, snapshot_name, mount_point):
+      '''Asks the array whether the given snapshot is currently attached to the given SMP'''
+      result = self._query(['snap', '-list', '-id', str(snapshot_name), '-detail'])
+      if result is None:
+        return False
+
+      snapshot = self._parse_snapshot_record(result.strip())
+      attached = str(getattr(snapshot, self.ATTACHED_PROPERTY, ''))
+      return str(mount_point) in LIST_SEPARATOR.split(attached)
+
+    def _wait(self, condition, seconds, description):
+      # nothing changes on the array during a dry run, so there is nothing to wait for
+      if env.dry_run:
+        return 0.0
+      return wait_until(condition, seconds or self.SETTLE_TIMEOUT,
+        error_message = "Timed out waiting for %s" % description)
+
+    def wait_for_snapshot_gone(self, snapshot_name, seconds=None):
+      '''Polls the array until the snapshot no longer exists, returning the seconds waited'''
+      return self._wait(lambda: not self.snapshot_exists(snapshot_name), seconds,
+        "snapshot %s to be destroyed" % snapshot_name)
+
+    def wait_for_snapshot(self, snapshot_name, seconds=None):
+      '''Polls the array until the snapshot exists, returning the seconds waited'''
+      return self._wait(lambda: self.snapshot_exists(snapshot_name), seconds,
+        "snapshot %s to be created" % snapshot_name)
+
+    def wait_for_attached(self, snapshot_name, mount_point, seconds=None):
+      '''Polls the array until the snapshot is attached to the SMP, returning the seconds waited'''
+      return self._wait(lambda: self.snapshot_attached(snapshot_name, mount_point), seconds,
+        "snapshot %s to be attached to %s" % (snapshot_name, mount_point))
+
+    def snapshot_attachments(self, snapshots=None):
+      '''
+      Maps the name of every snapshot to the SMPs it is attached to, from the given snapshots or
+      a fresh listing of the array
+      '''
+      snapshots = self.iter_snapshots() if snapshots is None else snapshots
+      return dict((str(snapshot.name), LIST_SEPARATOR.split(str(getattr(snapshot, self.ATTACHED_PROPERTY, ''))))
+        for snapshot in snapshots)
+
+    def wait_for_snapshots_gone(self, snapshot_names, seconds=None):
+      '''
+      Polls the array until none of the snapshots exist, returning the seconds waited. Every
+      check is a single listing, however many snapshots are waited on.
+      '''
+      names = set(str(name) for name in snapshot_names)
+      return self._wait(lambda: not names.intersection(self.snapshot_attachments()), seconds,
+        "snapshots %s to be destroyed" % ', '.join(sorted(names)))
+
+    def wait_for_snapshots(self, snapshot_names, seconds=None):
+      '''Polls the array until all of the snapshots exist, returning the seconds waited'''
+      names = set(str(name) for name in snapshot_names)
+      return self._wait(lambda: names.issubset(self.snapshot_attachments()), seconds,
+        "snapshots %s to be created" % ', '.join(sorted(names)))
+
+    def wait_for_all_attached(self, attachments, seconds=None):
+      '''
+      Polls the array until every snapshot in attachments (snapshot name -> SMP) is attached to its
+      SMP, returning the seconds waited. Every check is a single listing.
+      '''
+      def attached():
+        listed = self.snapshot_attachments()
+        return all(str(mount_point) in listed.get(str(name), []) for name, mount_point in attachments.items())
+      return self._wait(attached, seconds,
+        "snapshots %s to be attached" % ', '.join(sorted(str(name) for name in attachments)))
+
+    @contextmanager
+    def batch(self):
+      '''
+      Queues the volatile operations (create/delete/attach/detach) issued inside the block and
+      runs them when the block exits, so a group of operations is issued together and then waited
+      on once. Operations on different snapshots and LUNs (those of different hosts) run at the
+      same time, so a batch for N hosts takes about as long as one host's operations rather than
+      N times that. Those calls return their VnxOperation, which is filled in as its command
+      finishes. Queries still run immediately, so don't wait on queued operations inside the block.
+      '''
+      if self._batch is not None:
+        # already batching, so just keep queueing on the outer batch
+        yield self._batch
+        return
+
+      self._batch = []
+      try:
+        yield self._batch
+        operations = self._batch
+      finally:
+        self._batch = None
+      self._run_batch(operations)
+
+    def _chains(self, operations):
+      '''
+      Splits the queued operations into chains that share no snapshot or LUN, each chain in the
+      order its operations were queued (e.g. a host's detach and then destroy of its snapshot)
+      '''
+      chains = []
+      for position, operation in enumerate(operations):
+        linked    = [chain for chain in chains if chain[0] & operation.resources]
+        resources = operation.resources.union(*[chain[0] for chain in linked])
+        members   = sorted(sum([chain[1] for chain in linked], [(position, operation)]))
+        chains    = [chain for chain in chains if chain not in linked] + [(resources, members)]
+      return [[operation for _, operation in members] for _, members in chains]
+
+    def _run_chain(self, chain):
+      for operation in chain:
+        result = volatile_command(operation.command).run()
+        operation.return_code = result.return_code
+        operation.output      = (result + "\n" + result.stderr).strip()
+        # the rest of the chain depends on this one (attach after create, destroy after detach)
+        if operation.failed:
+          return
+
+    def _run_batch(self, operations):
+      '''
+      Runs the queued operations and fills each one in with its output and status. Every operation
+      is a naviseccli invocation of its own (the CLI has no session or script mode), so the chains
+      of operations on unrelated snapshots and LUNs run concurrently, up to
+      env.array_batch_workers at a time. A chain stops at its first failure, leaving the rest of it
+      unrun; unless env.warn_only is set, the batch aborts once every chain has finished.
+      '''
+      # set once around the threads, as fabric's settings() isn't safe to nest across them
+      with settings(warn_only=True):
+        concurrently(self._run_chain, self._chains(operations), env.array_batch_workers)
+
+      failed = [operation for operation in operations if operation.failed]
+      if failed and not env.warn_only:
+        abort("Array operation(s) failed:\n%s" % "\n".join("(%d) %s\n%s" % (operation.return_code,
+          operation.command, operation.output) for operation in failed))
+      return operations
+
+    def _volatile(self, cmd, resources=()):
+      # every volatile operation changes the snapshots, so any loaded listing (and the indexes on
+      # it) is now stale
+      self._snapshots = []
+      self._rebuild_indexes('snapshot')
+
+      command = self._build_command(cmd)
+      if self._batch is not None:
+        operation = VnxOperation(command, resources)
+        self._batch.append(operation)
+        return operation
 
-    def create_snapshot(self, lun_id, snapshot_name):
-      command = self._build_command(['snap', '-create', '-res', str(lun_id), '-restype', 'lun', '-name', snapshot_name, '-allowReadWrite', 'yes'])
       with volatile_command(command) as result:
         return result.succeeded
 
+    def create_snapshot(self, lun_id, snapshot_name):
+      return self._volatile(['snap', '-create', '-res', str(lun_id), '-restype', 'lun', '-name', snapshot_name, '-allowReadWrite', 'yes'],
+        [('snapshot', str(snapshot_name)), ('lun', str(lun_id))])
+
     def delete_snapshot(self, snapshot_name):
-      command = self._build_command(['snap', '-destroy', '-id', snapshot_name, '-o'])
-      with volatile_command(command) as result:
-        return result.succeeded
+      return self._volatile(['snap', '-destroy', '-id', snapshot_name, '-o'], [('snapshot', str(snapshot_name))])
 
     def attach_snapshot(self, snapshot_name, mount_point):
-      command = self._build_command(['snap', '-attach', '-id', str(snapshot_name), '-res', str(mount_point)])
-      with volatile_command(command) as result:
-        return result.succeeded
+      return self._volatile(['snap', '-attach', '-id', str(snapshot_name), '-res', str(mount_point)],
+        [('snapshot', str(snapshot_name)), ('lun', str(mount_point))])
 
     def detach_snapshot(self, snapshot_name, mount_point):
-      command = self._build_command(['snap', '-detach', '-id', snapshot_name, '-res', str(mount_point)])
-      with volatile_command(command) as result:
-        return result.succeeded
+      return self._volatile(['snap', '-detach', '-id', snapshot_name, '-res', str(mount_point)],
+        [('snapshot', str(snapshot_name)), ('lun', str(mount_point))])
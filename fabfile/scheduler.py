@@ -0,0 +1,348 @@
+'''
+Runs a graph of steps: each step starts as soon as the steps it comes after have finished and the
+resources it needs are available, so independent work (different hosts, different LUNs) overlaps.
+
+Resources are plain names, either a class ('array', 'ssh') or a class and an instance
+('host:mysql01.dev.lipsum.com'), and a step holds one unit of each of its resources while it runs.
+Limits are given per class, and apply to every instance of the class separately: with
+{ 'array': 4, 'host': 1 } up to four steps use the array at once, and one step at a time runs
+on each host.
+
+Steps run in forked processes of their own (fabric's env isn't safe to share between threads),
+and after a run the plan can report its critical path and how long each resource sat idle. Steps
+given a worker instead run one at a time in a long-lived process of that name, which keeps its
+ssh connections (fabric's connection cache) from one step to the next; a forked process can't use
+the connections of its parent, so this is how the steps on one host share a session.
+'''
+
+import ctypes, os, time, Queue
+from multiprocessing import Pipe, Process, Queue as ProcessQueue
+
+from fabric.api import puts, settings, hide
+from fabric.network import disconnect_all
+from fabric.state import connections
+
+# nothing from the rest of the fabfile package: envrestore.py loads this module on its own
+
+def _clock_gettime():
+  '''Returns a CLOCK_MONOTONIC reader (python 2 has no time.monotonic), or None if unavailable'''
+  for library in ('librt.so.1', None):
+    try:
+      librt = ctypes.CDLL(library, use_errno=True)
+      librt.clock_gettime
+      break
+    except (OSError, AttributeError):
+      librt = None
+  if not librt:
+    return None
+
+  class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+  CLOCK_MONOTONIC = 1
+  def _monotonic():
+    ts = timespec()
+    if librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+      raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+  return _monotonic
+
+# seconds on a clock that never goes backwards and is shared by every process on this host
+monotonic = _clock_gettime() or time.time
+
+def warm_connection(host):
+  '''
+  Opens the ssh connection to host ahead of the first command that needs it, and leaves it in
+  fabric's connection cache for every run()/sudo() on host in this process to open its channel
+  on. Returns whether that worked; a failure is left for those commands to report.
+  '''
+  try:
+    with settings(hide('everything'), abort_on_prompts=True):
+      connections[host]
+    return True
+  except (Exception, SystemExit):
+    return False
+
+PENDING   = 'pending'
+RUNNING   = 'running'
+SUCCEEDED = 'succeeded'
+FAILED    = 'failed'
+SKIPPED   = 'skipped'
+
+def run_isolated(func, *args, **kwargs):
+  '''
+  Runs func in a forked process of its own, returning None when it succeeds or the reason it
+  failed. Failures are returned rather than raised so one job can't take the others down with it.
+  '''
+  # ssh connections inherited from the parent can't be shared with it
+  connections.clear()
+  return _call(func, *args, **kwargs)
+
+def _call(func, *args, **kwargs):
+  try:
+    func(*args, **kwargs)
+    return None
+  except SystemExit:
+    # abort() has already reported the reason
+    return 'aborted'
+  except Exception, e:
+    return str(e) or e.__class__.__name__
+
+def _run_step(results, name, func, args, kwargs):
+  start = monotonic()
+  error = run_isolated(func, *args, **kwargs)
+  results.put((name, error, start, monotonic()))
+
+def _run_worker(results, steps):
+  '''Runs each step (or warmup) sent over steps until it sends None'''
+  connections.clear()
+  try:
+    for name, func, args, kwargs in iter(steps.recv, None):
+      start = monotonic()
+      error = _call(func, *args, **kwargs)
+      results.put((name, error, start, monotonic()))
+  finally:
+    disconnect_all()
+
+class Step(object):
+  def __init__(self, name, func, args=(), kwargs=None, after=(), resources=(), always=False, worker=None):
+    self.name      = name
+    self.func      = func
+    self.args      = tuple(args)
+    self.kwargs    = kwargs or {}
+    self.after     = list(after)
+    self.resources = list(resources)
+    # like a finally block: runs once the steps before it are done, even if they failed
+    self.always    = always
+    self.worker    = worker
+
+    self.state = PENDING
+    self.error = None
+    self.ready = self.start = self.end = None
+
+  @property
+  def duration(self):
+    return self.end - self.start if self.end is not None else 0.0
+
+  @property
+  def waited(self):
+    '''Seconds spent ready to run, but waiting for a resource'''
+    return self.start - self.ready if self.start is not None else 0.0
+
+class Plan(object):
+  def __init__(self, limits=None):
+    self.limits  = dict(limits or {})
+    self.steps   = []
+    self._steps  = {}
+    self.warmups = []
+    self.started = self.finished = None
+
+  def __getitem__(self, name):
+    return self._steps[name]
+
+  def add(self, name, func, args=(), kwargs=None, after=(), resources=(), always=False, worker=None):
+    '''
+    Adds a step and returns its name. Steps can only come after steps that were added before
+    them, which keeps the graph free of cycles. A step given a worker runs in that worker's
+    process (see warm), so its func and arguments have to be picklable.
+    '''
+    if name in self._steps:
+      raise ValueError("Step %s was already added" % name)
+    for dependency in after:
+      if dependency not in self._steps:
+        raise ValueError("Step %s comes after unknown step %s" % (name, dependency))
+
+    step = Step(name, func, args, kwargs, after, resources, always, worker)
+    self.steps.append(step)
+    self._steps[name] = step
+    return name
+
+  def warm(self, worker, func, args=(), resources=()):
+    '''
+    Has the worker run func(*args) ahead of its steps, e.g. to open the ssh connection its steps
+    will use while they still wait on their dependencies. A warmup holds its resources while it
+    runs like a step does, but only gets the capacity the ready steps leave over, so warming every
+    host of a large environment doesn't open more ssh connections at once than the 'ssh' limit
+    allows. Failures are left for the steps to report.
+    '''
+    self.warmups.append(Step("warm %s" % worker, func, args, resources=resources, worker=worker))
+
+  def limit(self, resource):
+    limit = self.limits.get(resource.split(':')[0])
+    return max(int(limit), 1) if limit is not None else None
+
+  def _available(self, step, held, busy):
+    if step.worker in busy:
+      return False
+    return all(self.limit(r) is None or held.get(r, 0) < self.limit(r) for r in step.resources)
+
+  def _resolve(self, now):
+    '''Skips the steps that can no longer run, and marks the ones whose dependencies are done as ready'''
+    for step in self.steps:
+      if step.state != PENDING or step.ready is not None:
+        continue
+      dependencies = [self._steps[name] for name in step.after]
+      if any(d.state in (PENDING, RUNNING) for d in dependencies):
+        continue
+      if not step.always and any(d.state != SUCCEEDED for d in dependencies):
+        step.state = SKIPPED
+        step.ready = step.start = step.end = now
+        continue
+      step.ready = now
+
+  def run(self):
+    '''
+    Runs every step, returning a dict mapping the names of the steps that failed to the reason.
+    Steps that come after a failed step are skipped (unless they always run), the others still
+    run to completion.
+    '''
+    results = ProcessQueue()
+    running = {}
+    held    = {}
+    busy    = set()
+    workers = {}
+    self.started = monotonic()
+
+    # warmups are scheduled like steps, but aren't part of the plan's results
+    by_name = dict((step.name, step) for step in self.steps + self.warmups)
+    for warmup in self.warmups:
+      warmup.ready = self.started
+
+    def worker(name):
+      if name not in workers:
+        steps, sender = Pipe(False)
+        workers[name] = (Process(target=_run_worker, args=(results, steps)), sender)
+        workers[name][0].start()
+      return workers[name]
+
+    def release(step):
+      process = running.pop(step.name)
+      if step.worker is None:
+        process.join()
+      elif process.exitcode is not None:
+        # the worker died with the step, the next step starts a new one
+        workers.pop(step.worker)
+        process.join()
+      busy.discard(step.worker)
+      for resource in step.resources:
+        held[resource] -= 1
+
+    try:
+      while True:
+        self._resolve(monotonic())
+        # steps first, so a warmup never holds up a step that could run
+        for step in self.steps + self.warmups:
+          if step.state == PENDING and step.ready is not None and self._available(step, held, busy):
+            step.state = RUNNING
+            step.start = monotonic()
+            for resource in step.resources:
+              held[resource] = held.get(resource, 0) + 1
+            if step.worker is None:
+              running[step.name] = Process(target=_run_step, args=(results, step.name, step.func, step.args, step.kwargs))
+              running[step.name].start()
+            else:
+              busy.add(step.worker)
+              running[step.name], sender = worker(step.worker)
+              try:
+                sender.send((step.name, step.func, step.args, step.kwargs))
+              except Exception, e:
+                # reported like any other failure, once the loop gets to it
+                results.put((step.name, "unable to hand to worker %s: %s" % (step.worker, e), step.start, monotonic()))
+
+        if not running:
+          break
+
+        # a timeout keeps the parent responsive to ctrl-c, and notices steps that died without a result
+        try:
+          name, error, start, end = results.get(True, 1)
+        except Queue.Empty:
+          for name, process in running.items():
+            # a worker only exits once it's told to, so any exit while it runs a step is a crash
+            if process.exitcode is not None and (process.exitcode != 0 or by_name[name].worker is not None):
+              step = by_name[name]
+              step.state, step.error, step.end = FAILED, "exited with code %d" % process.exitcode, monotonic()
+              release(step)
+          continue
+
+        step = by_name[name]
+        step.start, step.end = start, end
+        step.state, step.error = (FAILED, error) if error is not None else (SUCCEEDED, None)
+        release(step)
+    finally:
+      # on ctrl-c the steps are interrupted too; let them clean up after themselves
+      for process, sender in workers.values():
+        if process.is_alive():
+          sender.send(None)
+      for process in set(running.values()) | set(process for process, sender in workers.values()):
+        process.join()
+      self.finished = monotonic()
+
+    return dict((step.name, step.error) for step in self.steps if step.state == FAILED)
+
+  def critical_path(self):
+    '''
+    The chain of steps that decided how long the run took: starting from the step that finished
+    last, each step is preceded by the dependency that finished last
+    '''
+    finished = [step for step in self.steps if step.end is not None and step.state != SKIPPED]
+    if not finished:
+      return []
+
+    path = [max(finished, key=lambda step: step.end)]
+    while path[-1].after:
+      path.append(max((self._steps[name] for name in path[-1].after), key=lambda step: step.end))
+    return list(reversed(path))
+
+  def idle_time(self):
+    '''Maps every resource used to the seconds of the run it was busy, and the seconds it sat idle'''
+    wall      = self.finished - self.started
+    intervals = {}
+    for step in self.steps:
+      if step.state in (SUCCEEDED, FAILED):
+        for resource in step.resources:
+          intervals.setdefault(resource, []).append((step.start, step.end))
+
+    usage = {}
+    for resource, spans in intervals.items():
+      busy, until = 0.0, None
+      for start, end in sorted(spans):
+        if until is None or start > until:
+          busy += end - start
+          until = end
+        elif end > until:
+          busy += end - until
+          until = end
+      usage[resource] = (busy, max(wall - busy, 0.0))
+    return usage
+
+  def report(self):
+    '''Prints the critical path of the last run, and the idle time of each resource'''
+    wall = self.finished - self.started
+    path = self.critical_path()
+
+    puts("Critical path (%.1fs of %.1fs):" % (sum(step.duration + step.waited for step in path), wall), show_prefix=False)
+    for step in path:
+      waited = " (waited %.1fs for %s)" % (step.waited, ', '.join(step.resources)) if step.waited >= 0.05 else ''
+      puts("  %7.1fs %7.1fs  %-56s %s%s" % (step.start - self.started, step.duration, step.name, step.state, waited), show_prefix=False)
+
+    puts("Idle time:", show_prefix=False)
+    for resource, (busy, idle) in sorted(self.idle_time().items(), key=lambda item: -item[1][1]):
+      puts("  %-64s %7.1fs busy %7.1fs idle (%d%%)" % (resource, busy, idle, 100 * idle / wall if wall else 0), show_prefix=False)
+
+    skipped = [step.name for step in self.steps if step.state == SKIPPED]
+    if skipped:
+      puts("Skipped: %s" % ', '.join(skipped), show_prefix=False)
+
+def run_jobs(jobs, limit=None):
+  '''
+  Runs each (name, func, args) job in its own process, at most limit at a time, and returns a dict
+  mapping the names of the jobs that failed to the reason. Every job runs to completion even when
+  others fail.
+
+  The processes aren't daemonic (unlike multiprocessing.Pool's), so jobs can start processes of
+  their own: parallel fabric tasks, or the steps of an environment restore.
+  '''
+  plan = Plan({ 'job': limit or len(jobs) })
+  for name, func, args in jobs:
+    plan.add(name, func, args, resources=['job'])
+  return plan.run()
@@ -1,39 +1,246 @@
 import re
-from time import sleep
-from fabric.api import task, env
+from fabric.api import task, runs_once, env, puts, abort, settings
 
 from fabfile.sanclient import VnxClient, VnxConfig
+from fabfile.timeout import TimeoutError
 from fabfile.util import benchmark
 
+_client = None
+
+def client():
+  '''
+  The VnxClient shared by every host in this run. It loads lazily, so hosts only pay for the
+  targeted lookups they actually make rather than a full listing of the array each.
+  '''
+  global _client
+  if _client is None:
+    _client = VnxClient(
+      VnxConfig(
+        dry_run = env.dry_run,
+        debug = env.debugging,
+        cli_path = env.navisphere['cli']
+      )
+    )
+  return _client
+
+# a host's snapshot alternates between these names: the one attached to the host's SMP is its
+# active snapshot, and the other one (when it exists) the standby the next restore can swap in
+BUFFERS = ("%s-snap", "%s-snap-alt")
+
 def object_name_from_host_env(format_string):
   host = re.sub('^[^@]+@', '', env.host_string)
   return format_string % '-'.join(host.split('.')[0:2])
 
+def buffer_snapshots(vnx, mountpoint_lun_id):
+  '''
+  Returns the (name, snapshot) pairs of the current host's two buffers, active one first: whichever
+  is attached to its SMP, or the first one when neither is. snapshot is None for a buffer that
+  doesn't exist. Each buffer is asked for by name, so the answer is current without listing every
+  snapshot on the array.
+  '''
+  buffers  = [(name, vnx.get_snapshot_by_name(name, direct=True)) for name in [object_name_from_host_env(b) for b in BUFFERS]]
+  attached = vnx.snapshot_attachments([snapshot for name, snapshot in buffers if snapshot is not None])
+  active   = ([buffer for buffer in buffers if str(mountpoint_lun_id) in attached.get(buffer[0], [])] or buffers)[0]
+  return [active] + [buffer for buffer in buffers if buffer is not active]
+
+def usable(snapshot):
+  '''Whether a snapshot can be attached: it exists and is Ready (not still being created or destroyed)'''
+  return snapshot is not None and str(getattr(snapshot, 'state', '')) == 'Ready'
+
+def host_objects(vnx):
+  '''
+  Returns the active and standby snapshot names, SMP name, SMP LUN id and primary LUN id of the
+  current host
+  '''
+  mountpoint_name   = object_name_from_host_env("%s-smp")
+  mountpoint_lun_id = vnx.get_lun_by_name(mountpoint_name).id
+  (snapshot_name, active), (standby_name, standby) = buffer_snapshots(vnx, mountpoint_lun_id)
+
+  snapshot = active or standby
+  if snapshot is None:
+    abort("Unable to find snapshot %s of %s" % (snapshot_name, env.host_string))
+  return (snapshot_name, standby_name, mountpoint_name, mountpoint_lun_id, snapshot.primary_lun_s)
+
+def database_hosts():
+  '''The hosts of this run, or else the mongo and mysql hosts of the selected environment'''
+  return env.all_hosts or env.roledefs['mongo'] + env.roledefs['mysql']
+
+def hosts_objects(hosts):
+  '''host_objects() of every given host'''
+  vnx = client()
+  objects = []
+  for host in hosts:
+    with settings(host_string=host):
+      objects.append(host_objects(vnx))
+  return objects
+
+@task
+def detach(snapshot_name=None):
+  '''Detach the snapshot from the mountpoint of the given host'''
+  with benchmark('snapshot_detach'):
+    vnx = client()
+    mountpoint_lun_id = vnx.get_lun_by_name(object_name_from_host_env("%s-smp")).id
+    vnx.detach_snapshot(snapshot_name or object_name_from_host_env(BUFFERS[0]), mountpoint_lun_id)
+
+@task
+def destroy(snapshot_name=None):
+  '''Destroy the snapshot of the given host, waiting for the array to finish'''
+  with benchmark('snapshot_destroy'):
+    vnx = client()
+    snapshot_name = snapshot_name or object_name_from_host_env(BUFFERS[0])
+    try:
+      vnx.delete_snapshot(snapshot_name)
+      waited = vnx.wait_for_snapshot_gone(snapshot_name)
+      puts("Snapshot %s destroyed after %.1fs" % (snapshot_name, waited))
+    except TimeoutError, e:
+      abort(str(e))
+
+@task
+def create(lun_id, snapshot_name=None):
+  '''Create the snapshot of the given host from the given primary LUN'''
+  with benchmark('snapshot_create'):
+    vnx = client()
+    snapshot_name = snapshot_name or object_name_from_host_env(BUFFERS[0])
+    try:
+      vnx.create_snapshot(lun_id, snapshot_name)
+      waited = vnx.wait_for_snapshot(snapshot_name)
+      puts("Snapshot %s created after %.1fs" % (snapshot_name, waited))
+    except TimeoutError, e:
+      abort(str(e))
+
+@task
+def attach(snapshot_name=None):
+  '''Attach the snapshot to the mountpoint of the given host, waiting for the array to finish'''
+  with benchmark('snapshot_attach'):
+    vnx = client()
+    mountpoint_name   = object_name_from_host_env("%s-smp")
+    mountpoint_lun_id = vnx.get_lun_by_name(mountpoint_name).id
+    snapshot_name     = snapshot_name or object_name_from_host_env(BUFFERS[0])
+    try:
+      vnx.attach_snapshot(snapshot_name, mountpoint_lun_id)
+      waited = vnx.wait_for_attached(snapshot_name, mountpoint_lun_id)
+      puts("Snapshot %s attached to %s after %.1fs" % (snapshot_name, mountpoint_name, waited))
+    except TimeoutError, e:
+      abort(str(e))
+
 @task
 def recreate():
   '''Recreate the snapshot/mountpoint for the given host'''
   with benchmark('snapshot_recreate'):
-    client = VnxClient(
-      VnxConfig(
-        dry_run = env.dry_run,
-        debug = env.debugging,
-        cli_path = '/usr/bin/sudo /opt/Navisphere/bin/naviseccli'
-      )
-    )
+    snapshot_name, standby_name, mountpoint_name, mountpoint_lun_id, snapshot_lun_id = hosts_objects([env.host_string])[0]
+    vnx = client()
 
-    mountpoint_name   = object_name_from_host_env("%s-smp")
-    mountpoint_lun_id = client.get_lun_by_name(mountpoint_name).id
+    try:
+      with vnx.batch():
+        vnx.detach_snapshot(snapshot_name, mountpoint_lun_id)
+        vnx.delete_snapshot(snapshot_name)
+
+      # let the array finish the destroy before creating the replacement
+      waited = vnx.wait_for_snapshot_gone(snapshot_name)
+      puts("Snapshot %s destroyed after %.1fs" % (snapshot_name, waited))
 
-    snapshot_name   = object_name_from_host_env("%s-snap")
-    snapshot_lun_id = client.get_snapshot_by_name(snapshot_name).primary_lun_s
+      with vnx.batch():
+        vnx.create_snapshot(snapshot_lun_id, snapshot_name)
+        vnx.attach_snapshot(snapshot_name, mountpoint_lun_id)
+      waited = vnx.wait_for_attached(snapshot_name, mountpoint_lun_id)
+      puts("Snapshot %s created and attached to %s after %.1fs" % (snapshot_name, mountpoint_name, waited))
+    except TimeoutError, e:
+      abort(str(e))
 
-    client.detach_snapshot(snapshot_name, mountpoint_lun_id)
-    client.delete_snapshot(snapshot_name)
 
-    sleep(15) # let the array cool down
+def recreate_hosts(hosts):
+  '''
+  Recreates the snapshot/mountpoint of every given host at once: all the detaches and destroys go
+  to the array in one batch and share a single wait, then all the creates and attaches do.
+  '''
+  vnx     = client()
+  objects = hosts_objects(hosts)
 
-    client.create_snapshot(snapshot_lun_id, snapshot_name)
-    client.attach_snapshot(snapshot_name, mountpoint_lun_id)
+  try:
+    with vnx.batch():
+      for snapshot_name, _, mountpoint_name, mountpoint_lun_id, snapshot_lun_id in objects:
+        vnx.detach_snapshot(snapshot_name, mountpoint_lun_id)
+        vnx.delete_snapshot(snapshot_name)
+    waited = vnx.wait_for_snapshots_gone([snapshot_name for snapshot_name, _, _, _, _ in objects])
+    puts("%d snapshot(s) destroyed after %.1fs" % (len(objects), waited))
+
+    with vnx.batch():
+      for snapshot_name, _, mountpoint_name, mountpoint_lun_id, snapshot_lun_id in objects:
+        vnx.create_snapshot(snapshot_lun_id, snapshot_name)
+        vnx.attach_snapshot(snapshot_name, mountpoint_lun_id)
+    waited = vnx.wait_for_all_attached(dict((snapshot_name, mountpoint_lun_id)
+      for snapshot_name, _, _, mountpoint_lun_id, _ in objects))
+    puts("%d snapshot(s) created and attached after %.1fs" % (len(objects), waited))
+  except TimeoutError, e:
+    abort(str(e))
+
+@task
+@runs_once
+def recreate_all(*hosts):
+  '''Recreate the snapshots/mountpoints of the given hosts (or all database hosts) in one batch'''
+  with benchmark('snapshot_recreate_all'):
+    recreate_hosts(hosts or database_hosts())
+
+def missing_standbys(hosts):
+  '''The given hosts that have no standby snapshot ready to be swapped in'''
+  vnx     = client()
+  missing = []
+  for host in hosts:
+    with settings(host_string=host):
+      mountpoint_lun_id = vnx.get_lun_by_name(object_name_from_host_env("%s-smp")).id
+      (_, active), (_, standby) = buffer_snapshots(vnx, mountpoint_lun_id)
+      if not usable(standby):
+        missing.append(host)
+  return missing
+
+@task
+@runs_once
+def swap_all(*hosts):
+  '''
+  Swap the standby snapshot of the given hosts (or all database hosts) onto their mountpoints,
+  in one batch: the only array work a restore has to do while the databases are down
+  '''
+  with benchmark('snapshot_swap'):
+    vnx     = client()
+    objects = hosts_objects(hosts or database_hosts())
+
+    try:
+      with vnx.batch():
+        for snapshot_name, standby_name, mountpoint_name, mountpoint_lun_id, _ in objects:
+          vnx.detach_snapshot(snapshot_name, mountpoint_lun_id)
+          vnx.attach_snapshot(standby_name, mountpoint_lun_id)
+      waited = vnx.wait_for_all_attached(dict((standby_name, mountpoint_lun_id)
+        for _, standby_name, _, mountpoint_lun_id, _ in objects))
+      puts("%d standby snapshot(s) attached after %.1fs" % (len(objects), waited))
+    except TimeoutError, e:
+      abort(str(e))
+
+@task
+@runs_once
+def standby_all(*hosts):
+  '''
+  (Re)create the standby snapshot of the given hosts (or all database hosts) from their primary
+  LUN, replacing the one that is there, so the next restore only has to swap it in
+  '''
+  with benchmark('snapshot_standby'):
+    vnx     = client()
+    objects = hosts_objects(hosts or database_hosts())
+    found   = [(standby_name, vnx.get_snapshot_by_name(standby_name, direct=True)) for _, standby_name, _, _, _ in objects]
+    stale   = [standby_name for standby_name, standby in found if standby is not None]
 
-    sleep(15) # let the array cool down
+    try:
+      with vnx.batch():
+        for standby_name, standby in found:
+          # one that is already being destroyed only has to be waited for
+          if standby is not None and str(getattr(standby, 'state', '')) != 'Destroying':
+            vnx.delete_snapshot(standby_name)
+      waited = vnx.wait_for_snapshots_gone(stale)
+      puts("%d old snapshot(s) destroyed after %.1fs" % (len(stale), waited))
 
+      with vnx.batch():
+        for _, standby_name, _, _, snapshot_lun_id in objects:
+          vnx.create_snapshot(snapshot_lun_id, standby_name)
+      waited = vnx.wait_for_snapshots([standby_name for _, standby_name, _, _, _ in objects])
+      puts("%d standby snapshot(s) created after %.1fs" % (len(objects), waited))
+    except TimeoutError, e:
+      abort(str(e))
@@ -4,13 +4,17 @@
 # sublime: tab_size  2
 
 from contextlib import contextmanager
-import errno, os, signal, traceback, sys
+import errno, os, signal, traceback, sys, time
 from fabric.api import warn, abort
 
 class TimeoutError(Exception): pass
 
 DEFAULT_TIMEOUT_SECOND = 10
 
+DEFAULT_POLL_INTERVAL     = 0.25
+DEFAULT_POLL_BACKOFF      = 2
+DEFAULT_POLL_MAX_INTERVAL = 5
+
 @contextmanager
 def timeout(seconds = DEFAULT_TIMEOUT_SECOND, error_message = os.strerror(errno.ETIME)):
   def _handle_timeout(signum, frame):
@@ -54,3 +58,24 @@ def attempt_or_fail(seconds = DEFAULT_TIMEOUT_SECOND, timeout_handler = None, ex
     if hasattr(exception_handler, '__call__'):
       exception_handler(seconds, e, trace)
     abort("Operation failed: %s\n%s" % (e, trace))
+
+def wait_until(condition, seconds = DEFAULT_TIMEOUT_SECOND, interval = DEFAULT_POLL_INTERVAL,
+               backoff = DEFAULT_POLL_BACKOFF, max_interval = DEFAULT_POLL_MAX_INTERVAL,
+               error_message = os.strerror(errno.ETIME)):
+  '''
+  Polls condition() until it returns a true value, sleeping interval seconds after the first
+  miss and multiplying the interval by backoff (up to max_interval) after each further miss.
+  Returns the number of seconds spent waiting, or raises TimeoutError once seconds have passed.
+  '''
+  start    = time.time()
+  deadline = start + seconds
+  while True:
+    if condition():
+      return time.time() - start
+
+    now = time.time()
+    if now >= deadline:
+      raise TimeoutError(error_message)
+
+    time.sleep(min(interval, deadline - now))
+    interval = min(interval * backoff, max_interval)
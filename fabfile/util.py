@@ -1,15 +1,30 @@
 from contextlib import contextmanager
 from functools import wraps
 from time import localtime, time, strftime, gmtime
-import os, re, socket
+import atexit, errno, itertools, json, os, re, socket, subprocess, sys, tempfile, threading, Queue
 
 from fabric import tasks
-from fabric.api import settings, env, hide, local, prompt, abort, run, puts
+from fabric.api import settings, env, hide, local, prompt, abort, run, sudo, puts
 from fabric.utils import puts
 from fabric.colors import green
+from fabric.state import connections
+
+from fabfile import history
+from fabfile.scheduler import monotonic
 
 MAX_NODE_IDX = 50
 
+# host discovery
+DISCOVERY_WORKERS = 16
+PROBE_TIMEOUT     = 0.15
+
+# seconds the process waits at exit for a background revalidation of the discovery cache to finish
+REVALIDATE_WAIT   = 5
+
+HOST_UP           = 'up'
+HOST_DOWN         = 'down'
+HOST_UNRESOLVABLE = 'unresolvable'
+
 class local_command(str):
     def __init__(self, _command):
         self._result = None
@@ -78,10 +93,118 @@ class volatile_command(local_command):
             self._result.code = self._result.return_code
         return self._result
 
+def stream_command(command):
+    '''
+    Runs a local command, yielding its stdout line by line as it is produced instead of capturing
+    all of it first. Closing the generator early terminates the command. Like local(), a command
+    that runs to completion and fails aborts unless warn_only is set.
+    '''
+    if env.debugging:
+        puts("Running: " + green(command))
+
+    process  = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    finished = False
+    try:
+        for line in iter(process.stdout.readline, ''):
+            yield line
+        finished = True
+    finally:
+        if not finished and process.poll() is None:
+            process.terminate()
+        process.stdout.close()
+        process.wait()
+
+    if process.returncode != 0 and not env.warn_only:
+        abort("local() encountered an error (return code %d) while executing '%s'" % (process.returncode, command))
+
+# benchmark spans currently open in this thread (each thread, and each forked process, nests its own)
+_benchmark_state = threading.local()
+_span_ids        = itertools.count(1)
+_trace_lock      = threading.Lock()
+# a span's timings can be recorded from several threads at once (see concurrently)
+_timings_lock    = threading.Lock()
+
+def benchmark_stack():
+    if not hasattr(_benchmark_state, 'stack'):
+        _benchmark_state.stack = []
+    return _benchmark_state.stack
 
-benchmark_stack = []
 def benchmark_label():
-    return '.'.join(benchmark_stack)
+    return '.'.join(span['name'] for span in benchmark_stack())
+
+def record_timing(name, seconds):
+    '''
+    Attaches a timing measured inside the current benchmark span (e.g. on the remote host) to it,
+    so it is reported with the span and kept in its trace
+    '''
+    stack = benchmark_stack()
+    if stack:
+        with _timings_lock:
+            stack[-1].setdefault('timings', {})[name] = seconds
+
+def record_span(span):
+    '''Appends a finished benchmark span to env.trace_file as one line of JSON'''
+    if not env.get('trace_file'):
+        return
+
+    line = json.dumps(span) + "\n"
+    with _trace_lock:
+        # O_APPEND keeps lines from parallel (forked) tasks whole
+        fd = os.open(env.trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+def load_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def export_chrome_trace(spans, path):
+    '''
+    Writes the given spans as a Chrome trace-event file (chrome://tracing, Perfetto), with one
+    process track per host and a complete ('X') event per span
+    '''
+    origin = min([span['start'] for span in spans] or [0])
+    events = []
+    for pid in sorted(set(span['pid'] for span in spans)):
+        host = [span['host'] for span in spans if span['pid'] == pid][0]
+        events.append({ 'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0,
+                        'args': { 'name': "%s (pid %d)" % (host or 'local', pid) } })
+
+    for span in spans:
+        events.append({
+            'ph':   'X',
+            'name': span['name'],
+            'cat':  span['environment'] or 'envrestore',
+            'ts':   (span['start'] - origin) * 1e6,
+            'dur':  (span['end'] - span['start']) * 1e6,
+            'pid':  span['pid'],
+            'tid':  span['tid'],
+            'args': dict([(key, span[key]) for key in ('label', 'host', 'environment', 'state', 'id', 'parent')] +
+                         span.get('timings', {}).items())
+        })
+
+    with open(path, 'w') as f:
+        json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+
+def enable_tracing(path):
+    '''
+    Records every benchmark span of this run to <path>.jsonl and exports them as a Chrome trace
+    to <path>.json when the run exits
+    '''
+    env.trace_file = "%s.jsonl" % path
+    owner = os.getpid()
+
+    def _export():
+        # forked children share our atexit handlers, but only the parent should export
+        if os.getpid() == owner and os.path.exists(env.trace_file):
+            export_chrome_trace(load_spans(env.trace_file), "%s.json" % path)
+    atexit.register(_export)
+
+def environment_tag():
+    '''Tag for output lines, so interleaved output of parallel environment restores can be told apart'''
+    return "[%s] " % env.env if env.env else ''
 
 def benchmark(disable_if=None):
     def _wrap_as_new(original, new):
@@ -92,22 +215,40 @@ def benchmark(disable_if=None):
     @contextmanager
     def bench(task_name):
         state = 'succeeded'
-        indent = '=' * (len(benchmark_stack) * 2)
+        stack = benchmark_stack()
+        indent = '=' * (len(stack) * 2)
+        span = {
+            'id':          "%d.%d" % (os.getpid(), next(_span_ids)),
+            'parent':      stack[-1]['id'] if stack else None,
+            'name':        task_name,
+            'host':        env.host_string,
+            'environment': env.env,
+            'pid':         os.getpid(),
+            'tid':         threading.current_thread().ident,
+        }
         try:
-            benchmark_stack.append(task_name)
+            stack.append(span)
+            span['label'] = benchmark_label()
+            span['start'] = monotonic()
             start_time = time()
-            puts("%s====> Task '%s' started at %s" %
-                (indent, benchmark_label(), strftime("%a, %d %b %Y %H:%M:%S", localtime(start_time))))
+            puts("%s%s====> Task '%s' started at %s" %
+                (environment_tag(), indent, benchmark_label(), strftime("%a, %d %b %Y %H:%M:%S", localtime(start_time))))
             yield
         except (Exception, SystemExit), e:
             state = 'failed'
             raise e
         finally:
+            span['end'] = monotonic()
             end_time = time()
-            puts("<====%s Task '%s' %s at %s (runtime: %s)" %
-                (indent, benchmark_label(), state, strftime("%a, %d %b %Y %H:%M:%S",
-                    localtime(end_time)), strftime("%H:%M:%S", gmtime(end_time - start_time))))
-            benchmark_stack.pop()
+            with _timings_lock:
+                timings = ''.join(", %s: %.2fs" % item for item in sorted(span.get('timings', {}).items()))
+            puts("%s<====%s Task '%s' %s at %s (runtime: %s%s)" %
+                (environment_tag(), indent, benchmark_label(), state, strftime("%a, %d %b %Y %H:%M:%S",
+                    localtime(end_time)), strftime("%H:%M:%S", gmtime(end_time - start_time)), timings))
+            stack.pop()
+            span.update(state=state, wall_start=start_time, duration=span['end'] - span['start'])
+            record_span(span)
+            history.record(span)
 
     def real_decorator(func):
         @wraps(func)
@@ -157,6 +298,49 @@ def capture(command, warn_only=False):
         # so convert them to newlines (which is what we typically expect)
         return "\n".join(re.compile(r'(?:\r\n|\r)').split(run(command)))
 
+# kills every process holding the mount in one pass, then polls /proc until they (and any process that
+# took their place) are gone and unmounts straight away; prints the milliseconds that took
+RELEASE_MOUNT = '''
+  start=$(date +%%s%%N); deadline=$((start + %(seconds)d * 1000000000));
+  while pids=$(lsof -t %(path)s 2>/dev/null); [ -n "$pids" ]; do
+    [ $(date +%%s%%N) -ge $deadline ] && exit 2;
+    kill -9 $pids 2>/dev/null;
+    while :; do
+      alive=;
+      for p in $pids; do
+        [ -d /proc/$p ] && ! grep -q '^State:.*Z' /proc/$p/status 2>/dev/null && alive=$p && break;
+      done;
+      [ -z "$alive" ] && break;
+      [ $(date +%%s%%N) -ge $deadline ] && exit 2;
+      sleep %(interval)s;
+    done;
+  done;
+  umount %(path)s || exit 3;
+  echo "released $(( ($(date +%%s%%N) - start) / 1000000 ))"
+'''
+
+def release_mount(path, seconds=30, interval=0.05):
+    '''
+    Frees and unmounts the filesystem mounted at path on the current host in a single remote
+    command (see RELEASE_MOUNT), polling for the killed processes to exit every interval seconds.
+    Returns the seconds that took as measured on the host, and records them on the current
+    benchmark span. Aborts if the mount is still in use after the given number of seconds.
+    '''
+    with settings(hide('output', 'running', 'warnings'), warn_only=True):
+        result = sudo(RELEASE_MOUNT % { 'path': path, 'seconds': seconds, 'interval': interval })
+
+    if result.failed:
+        reason = "still in use after %ds" % seconds if result.return_code == 2 else result.strip() or "umount failed"
+        abort("Unable to release %s on %s: %s" % (path, env.host_string, reason))
+
+    released = re.search(r'released (\d+)', result)
+    if not released:
+        return None
+    elapsed = int(released.group(1)) / 1000.0
+    record_timing('teardown', elapsed)
+    puts("Released %s after %.2fs" % (path, elapsed))
+    return elapsed
+
 def runner():
   if 'runner' not in env:
     with settings(hide('running')):
@@ -182,10 +366,112 @@ def web_server_list(prefix='web', max_node_index=MAX_NODE_IDX, **kwargs):
 def php_server_list(prefix='php', max_node_index=MAX_NODE_IDX, **kwargs):
     return server_list(prefix, '', max_node_index=max_node_index, **kwargs)
 
+def concurrently(func, items, workers=DISCOVERY_WORKERS):
+    '''
+    Calls func once for every item using a bounded pool of threads, returning the results in the
+    same order as the given items. The first exception raised by func is re-raised in the caller
+    once every worker has finished.
+    '''
+    items   = list(items)
+    results = [None] * len(items)
+    errors  = []
+    pending = Queue.Queue()
+
+    for pair in enumerate(items):
+        pending.put(pair)
+
+    # spans opened by the workers nest under whatever span the caller is in; the workers share the
+    # caller's span objects, which is why record_timing locks
+    parent_stack = list(benchmark_stack())
+
+    def worker():
+        _benchmark_state.stack = list(parent_stack)
+        while True:
+            try:
+                idx, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[idx] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def probe_host(node_name, timeout=PROBE_TIMEOUT):
+    '''
+    Checks whether the given host resolves (A) and accepts connections on the ssh port (B),
+    returning HOST_UNRESOLVABLE, HOST_DOWN or HOST_UP respectively.
+    '''
+    try:
+        (family, socktype, proto, garbage, address) = socket.getaddrinfo(node_name, 'ssh')[0]
+    except socket.gaierror:
+        # unable to get address info for the specified hostname
+        if env.debugging: print "FAILED: Unable to get address for %s" % node_name
+        return HOST_UNRESOLVABLE
+
+    try:
+        s = socket.create_connection(address, timeout)
+        s.close()
+    except (socket.timeout, socket.error):
+        # either timed out on connect, or connection itself failed
+        if env.debugging: print "FAILED: Timedout or Socket Error on: %s" % node_name
+        return HOST_DOWN
+
+    if env.debugging: print "SUCCESS: Connected to %s" % node_name
+    return HOST_UP
+
+def discover_servers(groups, suffix='', user=None, max_node_index=MAX_NODE_IDX, env_short=None):
+    '''
+    Discovers the servers for several groups at once. groups maps a group name (typically a role)
+    to a prefix, or an iterable of prefixes, and the result maps each group name to its list of
+    "user@host" strings.
+
+    Every candidate name (prefix + node index from 1 to max_node_index) across all groups is
+    resolved and probed concurrently (see probe_host). Results are then walked in index order for
+    each prefix: the first unresolvable index marks the end of that prefix, hosts that resolve but
+    don't accept connections are skipped, and the rest are added in order.
+    '''
+
+    if not user: user = env.user
+    if not env_short: env_short = env.env_short
+
+    candidates = []
+    for group, prefixes in groups.items():
+        if not hasattr(prefixes, '__iter__'):
+            prefixes = [prefixes]
+        for prefix in prefixes:
+            for node_idx in range(1, max_node_index):
+                node_name = "%s%02d%s.%s.lipsum.com" % ( prefix, node_idx, suffix, env_short )
+                candidates.append((group, prefix, node_name))
+
+    states = concurrently(lambda candidate: probe_host(candidate[2]), candidates)
+
+    collection = dict((group, []) for group in groups)
+    exhausted  = set()
+    for (group, prefix, node_name), state in zip(candidates, states):
+        if (group, prefix) in exhausted:
+            continue
+        if state == HOST_UNRESOLVABLE:
+            # we've reached the number limit for that prefix
+            exhausted.add((group, prefix))
+        elif state == HOST_UP:
+            collection[group].append("%s@%s" % (user, node_name))
+    return collection
+
 def server_list(prefix, suffix='', user=None, max_node_index=MAX_NODE_IDX):
     '''
-    Get a list of valid php server hostnames by looping over all available prefixed name possibities
-    and node index numbers from 1 to MAX_PHP_NODE_IDX, and seeing if A. we can resolve it, and B. if
+    Get a list of valid server hostnames by looping over all available prefixed name possibities
+    and node index numbers from 1 to max_node_index, and seeing if A. we can resolve it, and B. if
     we can connect.
 
     If (A) fails (socket.gaierror), then we know we've reach the number limit for that prefix and can
@@ -195,42 +481,140 @@ def server_list(prefix, suffix='', user=None, max_node_index=MAX_NODE_IDX):
     currently, so we can skip it.
 
     If neither (A) nor (B) fail, then we simply add the host to our list as a viable host to connect to.
+
+    Candidates are probed concurrently; see discover_servers.
     '''
 
-    if not user: user = env.user
+    if not hasattr(prefix, '__iter__'):
+        # we only use one type with no suffix
+        suffix = ''
 
-    if hasattr(prefix, '__iter__'):
-        # if we were passed an iterable, use it (e.g., list, tuple)
-        prefixes = prefix
-    else:
-        # otherwise, we only use one type with no suffix
-        prefixes = [prefix]
-        suffix   = ''
+    return discover_servers({ 'servers': prefix }, suffix, user, max_node_index)['servers']
 
-    collection = []
+_discovery_cache_lock = (None, None)
+_revalidations        = []
 
-    for prefix in prefixes:
-        node_idx = 1
-        while node_idx < max_node_index:
-            try:
-                node_name = "%s%02d%s.%s.lipsum.com" % ( prefix, node_idx, suffix, env.env_short )
-                node_idx += 1
-
-                if env.debugging: print "Attempting connection to %s --> " % node_name,
-                (family, socktype, proto, garbage, address) = socket.getaddrinfo(node_name, 'ssh')[0]
-                s = socket.create_connection(address, 0.15)
-                s.close()
-
-                if env.debugging: print "SUCCESS"
-                collection.append("%s@%s" % (user, node_name))
-            except socket.gaierror:
-                # unable to get address info for the specified hostname
-                if env.debugging: print "FAILED: Unable to get address for %s" % node_name
-                break
-            except (socket.timeout, socket.error):
-                # either timed out on connect, or connection itself failed
-                # in either case, we should skip the host
-                if env.debugging: print "FAILED: Timedout or Socket Error on: %s" % node_name
-                pass
-    return collection
+def discovery_cache_lock():
+    '''
+    The lock around discovery cache writes. A forked process gets a new one, as the copy it inherits
+    stays locked forever if the fork happened while another thread of the parent held it.
+    '''
+    global _discovery_cache_lock
+    pid, lock = _discovery_cache_lock
+    if pid != os.getpid():
+        _discovery_cache_lock = (os.getpid(), threading.Lock())
+    return _discovery_cache_lock[1]
+
+def discovery_cache_key(env_short, user=None):
+    '''
+    The discovery cache entry for env_short as seen by user (env.user by default); cached hosts are
+    "user@host" strings, so each user gets entries of their own
+    '''
+    return "%s@%s" % (user or env.user, env_short)
+
+def load_discovery_cache(path=None):
+    '''
+    Loads the on-disk discovery cache, which maps user@env_short -> role -> { 'hosts', 'updated' }
+    (see discovery_cache_key)
+    '''
+    path = path or env.discovery_cache
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def update_discovery_cache(key, roledefs, path=None):
+    '''
+    Stores the given role -> hosts mapping under key (see discovery_cache_key) in the discovery
+    cache. The file is rewritten through a temporary file and renamed into place so readers never
+    see partial writes.
+    '''
+    path = path or env.discovery_cache
+    with discovery_cache_lock():
+        cache = load_discovery_cache(path)
+        for role, hosts in roledefs.items():
+            cache.setdefault(key, {})[role] = { 'hosts': hosts, 'updated': time() }
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.rename(tmp_path, path)
+
+def clear_discovery_cache(env_short=None, path=None):
+    '''
+    Removes the cached roles for env_short (for every user), or the whole cache if no environment
+    is given
+    '''
+    path = path or env.discovery_cache
+    with discovery_cache_lock():
+        cache = load_discovery_cache(path)
+        if env_short:
+            for key in [key for key in cache if key.split('@', 1)[-1] == env_short]:
+                del cache[key]
+        else:
+            cache = {}
+        if os.path.exists(path):
+            with open(path, 'w') as f:
+                json.dump(cache, f, indent=2)
+
+def cached_discovery(groups, ttl=None, refresh=False, **kwargs):
+    '''
+    Returns discover_servers() results for the current environment, serving each group from the
+    discovery cache when its entry is younger than ttl seconds (env.discovery_ttl by default).
+
+    Groups served from the cache are re-probed by a background thread which writes the result back
+    to the cache for the next run; the current run keeps the cached hosts. Groups that are missing
+    or expired (or everything, when refresh is set) are discovered synchronously.
+    '''
+    env_short = kwargs.setdefault('env_short', env.env_short)
+    key       = discovery_cache_key(env_short, kwargs.get('user'))
+    ttl       = env.discovery_ttl if ttl is None else ttl
+
+    if not env.discovery_cache or ttl <= 0:
+        return discover_servers(groups, **kwargs)
+
+    cached = {} if refresh else load_discovery_cache().get(key, {})
+    now    = time()
+
+    fresh  = dict((group, [str(host) for host in cached[group]['hosts']]) for group in groups
+                  if group in cached and now - cached[group]['updated'] < ttl)
+    stale  = dict((group, prefix) for group, prefix in groups.items() if group not in fresh)
+
+    if stale:
+        found = discover_servers(stale, **kwargs)
+        update_discovery_cache(key, found)
+        fresh.update(found)
+
+    revalidate = dict((group, prefix) for group, prefix in groups.items() if group not in stale)
+    if revalidate:
+        def _revalidate():
+            found = discover_servers(revalidate, **kwargs)
+            update_discovery_cache(key, found)
+            if env.debugging and any(found[group] != fresh[group] for group in found):
+                print "Discovery cache for %s was out of date and has been updated" % env_short
+
+        # a daemon, which the process waits for at exit only up to REVALIDATE_WAIT seconds (see
+        # finish_revalidations); an update cut short leaves the previous cache file in place
+        revalidation = threading.Thread(target=_revalidate, name='discovery.revalidate')
+        revalidation.daemon = True
+        revalidation.start()
+        _revalidations.append(revalidation)
+
+    return fresh
+
+def finish_revalidations(timeout=REVALIDATE_WAIT):
+    '''
+    Gives the background revalidations of the discovery cache up to timeout seconds (in all) to
+    finish, so that a short task such as setenv or list_servers still updates the cache
+    '''
+    deadline = time() + timeout
+    while _revalidations:
+        _revalidations.pop().join(max(deadline - time(), 0))
 
+atexit.register(finish_revalidations)